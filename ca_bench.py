@@ -0,0 +1,302 @@
+import argparse
+import concurrent.futures
+import hashlib
+import itertools
+import json
+import platform
+import time
+import tracemalloc
+import numpy as np
+import ca_eco
+import ca_world
+from ca_domain import DomainWorld
+from ca_frames import FrameEncoder, decode_frame
+from ca_random import RandomSource
+
+# Times the simulation kernels and the frame pipeline, and checks the fast engines against the
+# reference ones:
+#
+#   python ca_bench.py --save bench.json                        # record a baseline
+#   python ca_bench.py --compare bench.json                     # flag regressions against it
+#   python ca_bench.py --n 256 1024 --p 0.02 0.05 --q 0.2 0.4 --model eco --mode sublattice
+#   python ca_bench.py --n 4096 8192 --model eco --mode sublattice --domain-workers 1 2 4 8
+#
+# Every case (model, engine, mode, n, p, q) runs in a fresh process, from a seeded world, so
+# cases do not warm each other's caches and every run of the suite simulates the same
+# generations. Each one is timed for at least --min-time seconds (and one generation): steps per
+# second, init_world, and encoding each frame as the server sends it and decoding it as the
+# browser does. Peak memory comes from a separate pass of --memory-generations under tracemalloc,
+# which would slow the timed one down (for a world split among processes, see ca_domain, it only
+# covers the first). At n=4096 a sequential ca_eco step takes most of a minute.
+
+# What is measured of a case: whether more of it is better, and the smallest change in it that is
+# more than timer noise, for --compare.
+METRICS = {
+    'generations_per_sec': (True, 0),
+    'init_ms': (False, 1.0),
+    'encode_ms': (False, 0.2),
+    'decode_ms': (False, 0.2),
+    'frame_bytes': (False, 0),
+    'peak_mb': (False, 1.0),
+}
+
+
+def case_name(case, viewport=None):
+    model, engine, mode, n, p, q = case
+    name = '%s/%s%s n=%d p=%g q=%g' % (model, engine, '/%s' % mode if mode else '', n, p, q)
+    return name + ' viewport=%d' % viewport if viewport else name
+
+
+def stepper(model, engine, mode, n, p, q, seed):
+    ''' A seeded world of model, a function that steps a world on by one generation, and one to
+        call once done. The 'domain' engine of ca_eco splits the world among mode processes. '''
+    rng = RandomSource(seed)
+    if model == 'eco' and engine == 'domain':
+        world = DomainWorld(ca_eco.init_world(n, p, q, rng.generator), mode, seed = seed)
+
+        def step(W):
+            world.step()
+            return world.W
+        return world.W, step, world.close
+    elif model == 'eco':
+        W = ca_eco.init_world(n, p, q, rng.generator)
+        index = ca_eco.CellIndex(W)
+
+        def step(W):
+            return ca_eco.time_step(W, index, engine, mode, rng)
+    else:
+        W = ca_world.init_world(n, p, q, rng.generator)
+        spare = [np.empty_like(W)]
+
+        # ca_world steps into a second buffer; the two take turns.
+        def step(W):
+            M = ca_world.time_step(W, spare[0], engine, rng)
+            spare[0] = W
+            return M
+    return W, step, lambda: None
+
+
+def bench_case(case, seed, min_time, max_generations, memory_generations, viewport):
+    ''' The METRICS of one case. '''
+    # Peak memory first, which also warms up whatever the engines keep between steps.
+    tracemalloc.start()
+    W, step, close = stepper(*case, seed)
+    encoder = FrameEncoder(viewport = viewport)
+    for generation in range(memory_generations):
+        W = step(W)
+        encoder.encode(generation, W)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    close()
+
+    start = time.perf_counter()
+    W, step, close = stepper(*case, seed)
+    init = time.perf_counter() - start
+
+    encoder = FrameEncoder(viewport = viewport)
+    types = None
+    step_time = encode_time = decode_time = frame_bytes = 0
+    generations = 0
+    while generations < max(max_generations, 1) and (generations == 0 or step_time < min_time):
+        start = time.perf_counter()
+        W = step(W)
+        stepped = time.perf_counter()
+        frame = encoder.encode(generations, W)
+        encoded = time.perf_counter()
+        _, _, types = decode_frame(frame, types)
+        decoded = time.perf_counter()
+
+        step_time += stepped - start
+        encode_time += encoded - stepped
+        decode_time += decoded - encoded
+        frame_bytes += len(frame)
+        generations += 1
+    close()
+
+    return {
+        'generations': generations,
+        'generations_per_sec': generations / step_time,
+        'init_ms': 1000 * init,
+        'encode_ms': 1000 * encode_time / generations,
+        'decode_ms': 1000 * decode_time / generations,
+        'frame_bytes': frame_bytes / generations,
+        'peak_mb': peak / 2**20,
+    }
+
+
+def digest(W):
+    return hashlib.sha1(np.ascontiguousarray(W).tobytes()).hexdigest()
+
+
+def population_z(runs, reference):
+    ''' The largest difference between the mean populations of any cell type in two sets of runs
+        (one row of counts per run), in standard errors. '''
+    runs, reference = np.array(runs, dtype = float), np.array(reference, dtype = float)
+    error = np.sqrt(runs.var(axis = 0, ddof = 1) / len(runs) + reference.var(axis = 0, ddof = 1) / len(reference))
+    return (np.abs(runs.mean(axis = 0) - reference.mean(axis = 0)) / np.maximum(error, 1e-9)).max()
+
+
+def check_engines(seed, n=40, generations=15, seeds=30):
+    ''' Runs every engine from the same seeded worlds and checks the fast ones against the
+        reference. ca_world's engines draw the same random numbers, so they must agree bit for
+        bit; ca_eco's fast births draw theirs differently and agree only in distribution, so
+        there the mean population of each cell type after some generations, over seeds runs,
+        must be within 4 standard errors of the reference's, and so must it after every
+        generation on the way, so that a fast engine cannot drift and come back. So must a world split among
+        processes (see ca_domain), against the sublattice mode whose moves it makes. That mode
+        goes by the critters in sparse worlds (see ca_eco.SPARSE_OCCUPANCY), and must agree bit
+        for bit with going by the cells.
+        Returns (name, ok, detail) for each check, and the digest of every engine's world after
+        generations from seed, to notice any change in what an engine computes. '''
+    checks = []
+    digests = {}
+
+    worlds = {}
+    for engine in ca_world.ENGINES:
+        W, step, _ = stepper('world', engine, None, n, 0.3, 0.3, seed)
+        for _ in range(generations):
+            W = step(W)
+        worlds[engine] = W
+        digests['world/' + engine] = digest(W)
+    equal = np.array_equal(worlds['numpy'], worlds['reference'])
+    checks.append(('world/numpy = world/reference', equal, 'bit for bit' if equal else 'worlds differ'))
+
+    sublattice = []
+    saved = ca_eco.SPARSE_OCCUPANCY
+    for occupancy in (0, 1):
+        ca_eco.SPARSE_OCCUPANCY = occupancy
+        W, step, _ = stepper('eco', 'numpy', 'sublattice', n, 0.02, 0.2, seed)
+        for _ in range(generations):
+            W = step(W)
+        sublattice.append(W)
+    ca_eco.SPARSE_OCCUPANCY = saved
+    equal = np.array_equal(*sublattice)
+    checks.append(('eco/numpy/sublattice sparse = dense', equal, 'bit for bit' if equal else 'worlds differ'))
+
+    # The population of each cell type after every generation: one (generations, types) array per run.
+    counts = {}
+    for engine, mode in list(itertools.product(ca_eco.ENGINES, ca_eco.MODES)) + [('domain', 1), ('domain', 3)]:
+        name = 'eco/%s/%s' % (engine, mode)
+        counts[name] = []
+        for run_seed in range(seed, seed + seeds):
+            W, step, close = stepper('eco', engine, mode, n, 0.02, 0.2, run_seed)
+            trajectory = []
+            for _ in range(generations):
+                W = step(W)
+                trajectory.append(np.bincount(W[:, :, 0].ravel(), minlength = ca_eco.TYPES))
+            counts[name].append(trajectory)
+            if run_seed == seed:
+                digests[name] = digest(W)
+            close()
+        counts[name] = np.array(counts[name])
+
+    for name, reference in [('eco/numpy/%s' % mode, 'eco/reference/%s' % mode) for mode in ca_eco.MODES] + [
+            ('eco/domain/1', 'eco/numpy/sublattice'), ('eco/domain/3', 'eco/numpy/sublattice')]:
+        z = population_z(counts[name][:, -1], counts[reference][:, -1])
+        checks.append(('%s ~ %s' % (name, reference), z < 4, 'max |z| %.2f over %d seeds' % (z, seeds)))
+        z, worst = max((population_z(counts[name][:, g], counts[reference][:, g]), g + 1) for g in range(generations))
+        checks.append(('%s ~ %s every generation' % (name, reference), z < 4,
+                       'max |z| %.2f, at generation %d of %d, over %d seeds' % (z, worst, generations, seeds)))
+    return checks, digests
+
+
+def compare(result, baseline, tolerance):
+    ''' The metrics of result more than tolerance (a fraction) worse than in baseline. '''
+    worse = []
+    for metric, (more_is_better, noise) in METRICS.items():
+        old, new = baseline.get(metric), result[metric]
+        if not old or abs(new - old) <= noise:
+            continue
+        change = (new - old) / old
+        if (-change if more_is_better else change) > tolerance:
+            worse.append('%s %+.0f%%' % (metric, 100 * change))
+    return worse
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark the simulation kernels and the frame pipeline.')
+    parser.add_argument('--model', choices = ['eco', 'world'], nargs = '+', default = ['eco', 'world'])
+    parser.add_argument('--engine', choices = sorted(ca_eco.ENGINES), nargs = '+', default = ['numpy'],
+                        help = 'engines to time (the reference ones are slow past n=256)')
+    parser.add_argument('--mode', choices = sorted(ca_eco.MODES), nargs = '+', default = sorted(ca_eco.MODES),
+                        help = 'ca_eco movement modes to time')
+    parser.add_argument('--domain-workers', type = int, nargs = '+', default = [],
+                        help = 'also time ca_eco worlds split among this many processes (see ca_domain)')
+    parser.add_argument('--n', type = int, nargs = '+', default = [64, 256, 1024, 4096], help = 'world sizes')
+    parser.add_argument('--p', type = float, nargs = '+', default = [0.02], help = 'initial shares of the first type')
+    parser.add_argument('--q', type = float, nargs = '+', default = [0.2], help = 'initial shares of the second type')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--min-time', type = float, default = 2.0, help = 'seconds to time each case for, at least')
+    parser.add_argument('--max-generations', type = int, default = 500)
+    parser.add_argument('--memory-generations', type = int, default = 2)
+    parser.add_argument('--viewport', type = int, help = 'encode frames downsampled to this many pixels across')
+    parser.add_argument('--save', help = 'save the results to this file, as a baseline')
+    parser.add_argument('--compare', help = 'flag results more than --tolerance worse than in this baseline')
+    parser.add_argument('--tolerance', type = float, default = 0.25)
+    parser.add_argument('--no-check', action = 'store_true', help = 'skip checking the engines against the reference')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    cases = []
+    for model, engine, n, p, q in itertools.product(args.model, args.engine, args.n, args.p, args.q):
+        for mode in (args.mode if model == 'eco' else [None]):
+            cases.append((model, engine, mode, n, p, q))
+    for workers, n, p, q in itertools.product(args.domain_workers, args.n, args.p, args.q):
+        cases.append(('eco', 'domain', workers, n, p, q))
+
+    failed = False
+    print('%-44s %9s %9s %9s %9s %10s %8s' % ('case', 'gens/s', 'init ms', 'enc ms', 'dec ms', 'frame kB', 'peak MB'))
+    results = {}
+    for case in cases:
+        name = case_name(case, args.viewport)
+        # A process of its own for every case.
+        with concurrent.futures.ProcessPoolExecutor(1) as pool:
+            result = pool.submit(bench_case, case, args.seed, args.min_time, args.max_generations,
+                                 args.memory_generations, args.viewport).result()
+        results[name] = result
+        line = '%-44s %9.2f %9.1f %9.2f %9.2f %10.1f %8.1f' % (
+            name, result['generations_per_sec'], result['init_ms'], result['encode_ms'],
+            result['decode_ms'], result['frame_bytes'] / 1024, result['peak_mb'])
+        if baseline is not None:
+            if name not in baseline['cases']:
+                line += '  (not in baseline)'
+            else:
+                worse = compare(result, baseline['cases'][name], args.tolerance)
+                if worse:
+                    failed = True
+                    line += '  REGRESSION: ' + ', '.join(worse)
+        print(line, flush = True)
+
+    digests = {}
+    if not args.no_check:
+        checks, digests = check_engines(args.seed)
+        for name, ok, detail in checks:
+            failed |= not ok
+            print('%-44s %s (%s)' % (name, 'ok' if ok else 'FAILED', detail))
+        if baseline is not None:
+            for name, value in digests.items():
+                if baseline.get('digests', {}).get(name, value) != value:
+                    failed = True
+                    print('%-44s CHANGED: seeded runs no longer match the baseline' % name)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'machine': platform.platform(),
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'args': vars(args),
+                'cases': results,
+                'digests': digests,
+            }, f, indent = 1)
+        print('results saved to', args.save)
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
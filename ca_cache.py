@@ -0,0 +1,177 @@
+import fcntl
+import hashlib
+import json
+import os
+import numpy as np
+from ca_frames import STATS, FrameEncoder, decode_frame
+from ca_history import INDEX, RunHistory
+
+
+def cache_key(params):
+    ''' The name a run goes by in the cache: a hash of everything that decides it, as a dict
+        (model, n, p, q, rule constants, seed, ...), so runs with the same params share it. '''
+    return hashlib.sha1(json.dumps(params, sort_keys = True).encode()).hexdigest()
+
+
+class ResultCache:
+    ''' Runs kept on disk so they need not be simulated again: every frame at full resolution
+        (a RunHistory), the population statistics of every generation, and, for carrying on from
+        where they got to, a checkpoint of the world and random state at their last generation.
+        Once all of them take more than max_bytes, the ones used least recently are thrown away. '''
+
+    def __init__(self, folder, max_bytes=1 << 30):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        os.makedirs(folder, exist_ok = True)
+
+    def open(self, params):
+        ''' The CachedRun for these params, empty if they have never been run, or None if a run
+            with the same params is using it right now. '''
+        key = cache_key(params)
+        lock = self.lock(key)
+        if lock is None:
+            return None
+        return CachedRun(self, key, params, lock)
+
+    def lock(self, key):
+        ''' The run's .lock file, locked, or None if something else has it locked. evict() deletes
+            the file while it has it locked; one opened before that and locked after is a lock on
+            nothing, so the file is opened again until the one locked is the one in the folder. '''
+        path = os.path.join(self.folder, key + '.lock')
+        while True:
+            lock = open(path, 'w')
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock.close()
+                return None
+            try:
+                if os.stat(path).st_ino == os.fstat(lock.fileno()).st_ino:
+                    return lock
+            except FileNotFoundError:
+                pass
+            lock.close()
+
+    def evict(self):
+        ''' Throws runs away, least recently used first, until the rest fit in max_bytes.
+            Runs in use are left alone. '''
+        runs = []
+        for name in os.listdir(self.folder):
+            key, ext = os.path.splitext(name)
+            if ext == '.json':
+                history = RunHistory(self.folder, key)
+                runs.append((os.path.getmtime(history.path('.json')), key, history))
+
+        total = sum(history.nbytes() + extra_bytes(history) for _, _, history in runs)
+        for _, key, history in sorted(runs):
+            if total <= self.max_bytes:
+                break
+            lock = self.lock(key)
+            if lock is None:
+                continue
+            total -= history.nbytes() + extra_bytes(history)
+            for ext in ('.json', '.frames', '.index', '.stats', '.state.npz', '.lock'):
+                if os.path.exists(history.path(ext)):
+                    os.remove(history.path(ext))
+            lock.close()
+
+
+def extra_bytes(history):
+    # What the cache keeps of a run besides its RunHistory.
+    paths = [history.path(ext) for ext in ('.stats', '.state.npz')]
+    return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+
+class CachedRun:
+    ''' One run in the cache, held for one simulation at a time (see ResultCache.open).
+        Its frames can be replayed up to its checkpoint, and the simulation carried on from there,
+        adding frames as it goes and a new checkpoint at the end, or once the run has grown as
+        big as the cache may be (see room). '''
+
+    def __init__(self, cache, key, params, lock):
+        self.cache = cache
+        self.lock = lock
+        self.history = RunHistory.create(cache.folder, key, params)
+        self.stats_file = open(self.history.path('.stats'), 'a+b')
+        self.encoder = FrameEncoder()
+        self.state = None
+
+        # Frames from after the checkpoint, from a run that never got to save one, can not be
+        # carried on from; drop them.
+        path = self.history.path('.state.npz')
+        if os.path.exists(path):
+            with np.load(path) as state:
+                self.state = {name: state[name] for name in state.files}
+        generations = self.history.index()['generation']
+        last = int(self.state['generation']) if self.state else -1
+        count = int(np.searchsorted(generations, last, side = 'right'))
+        if os.path.getsize(self.history.path('.stats')) < count * STATS.size:
+            # Not every generation has its stats: start it over.
+            count = 0
+            self.state = None
+        self.history.truncate(count)
+        self.stats_file.truncate(count * STATS.size)
+        self.nbytes = self.history.size + count * (INDEX.itemsize + STATS.size)
+        self.last_bytes = 0
+
+    def generations(self):
+        ''' How many generations there are to replay. '''
+        return len(self.history.index())
+
+    def replay(self):
+        ''' The cell types and the population statistics (a STATS message) of every generation
+            cached, in order, as (generation, types, stats). '''
+        types = None
+        self.stats_file.seek(0)
+        for entry in self.history.index():
+            generation, _, types = decode_frame(self.history.frame(entry), types)
+            yield generation, types, self.stats_file.read(STATS.size)
+
+    def checkpoint(self):
+        ''' (generation, W, order of its CellIndex, rng state) to carry on from,
+            or None if there is nothing cached. '''
+        if self.state is None:
+            return None
+        order = [self.state['order%d' % kind] for kind in range(4)]
+        rng_state = {
+            'generator': json.loads(str(self.state['generator'])),
+            'block': self.state['block'].tolist(),
+        }
+        return int(self.state['generation']), self.state['W'].copy(), order, rng_state
+
+    def append(self, generation, W, stats):
+        ''' Adds another generation, simulated just now: its frame, and its stats (a STATS message). '''
+        frame = self.encoder.encode(generation, W)
+        self.history.append(frame)
+        self.stats_file.write(stats)
+        self.last_bytes = len(frame) + INDEX.itemsize + len(stats)
+        self.nbytes += self.last_bytes
+
+    def room(self, W, rng):
+        ''' Whether the run has room in the cache's max_bytes for another generation (about as
+            big as the last) after this one, and then a checkpoint of world W and rng. Once it has
+            not, no more of the run can be kept: ca_eco.cache_generation saves the checkpoint
+            then and closes the run. '''
+        # A checkpoint holds the world, the position of every cell in its CellIndex, the random
+        # numbers drawn but not handed out yet (a block at most), and a little more.
+        checkpoint_bytes = W.nbytes + 4 * W.shape[0] * W.shape[1] + 8 * rng.block_size + 4096
+        return self.nbytes + self.last_bytes + checkpoint_bytes <= self.cache.max_bytes
+
+    def save(self, generation, W, index, rng):
+        ''' Saves the checkpoint to carry on from: world W after this generation, its CellIndex and rng. '''
+        path = self.history.path('.state.npz')
+        rng_state = rng.getstate()
+        order = {'order%d' % kind: cells for kind, cells in enumerate(index.order())}
+        # Written in full before it replaces the last one, so a crash never leaves half a checkpoint.
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, generation = generation, W = W, generator = json.dumps(rng_state['generator']),
+                     block = np.array(rng_state['block'], dtype = np.float64), **order)
+        os.replace(path + '.tmp', path)
+
+    def close(self):
+        ''' Lets go of the run, marking it as just used, and makes room in the cache. '''
+        self.history.close()
+        self.stats_file.close()
+        os.utime(self.history.path('.json'))
+        self.lock.close()
+        self.cache.evict()
@@ -0,0 +1,227 @@
+import multiprocessing
+import threading
+from multiprocessing import shared_memory
+import numpy as np
+import ca_eco
+from ca_random import RandomSource
+
+# Worlds too big for one core, split into strips of rows, each stepped by a process of its own.
+#
+# The world lives in shared memory, so nothing is copied between the processes: a strip's
+# neighbors read its border rows (their halo) right where they are, and frames are encoded
+# straight from it. Cells find their neighbors through the same wrap-around tables as in ca_eco,
+# so the world is still a torus, the first strip's neighbor above being the last.
+#
+# Every phase of a step goes sublattice by sublattice (see ca_eco.sublattices), in an order all
+# the strips draw alike. Cells of one sublattice are at least 3 apart, so whatever strip they are
+# in they look at and change different cells, and can all be updated at once; the strips wait for
+# each other (at a barrier) before going on to the next sublattice. Critters move as in the
+# 'sublattice' mode of ca_eco.time_step. Births and deaths follow the rules of ca_eco too, empty
+# and plant cells taking their turns sublattice by sublattice rather than in an order of their own.
+#
+# Layout of the shared memory: the world (n x n x 2 bytes), which critters are yet to move this
+# step (n x n bools), and a flag telling the workers to stop.
+
+
+class DomainWorld:
+    ''' World W, split among workers processes that step it on together, each its own strip of
+        rows. Its cells are self.W, in shared memory; look at them between steps, not during one.
+        A seeded world is stepped the same every time, for the same number of workers. '''
+
+    def __init__(self, W, workers, rules=None, seed=None):
+        n = W.shape[0]
+        workers = max(1, min(workers, n))
+        self.shm = shared_memory.SharedMemory(create = True, size = 3 * n * n + 1)
+        self.W, _, self.stop = views(self.shm, n)
+        self.W[...] = W
+        self.stop[0] = 0
+
+        # Every strip draws its random numbers from a seed of its own, all made from this one.
+        entropy = np.random.SeedSequence(seed).entropy
+        # The workers are forked from this process, whatever way it was started itself (a pool
+        # worker comes from a fork server, see ca_pool), which is quick and shares its resource tracker.
+        context = multiprocessing.get_context('fork')
+        # The workers and this process meet at step at the start and end of every step, and the
+        # workers at phase between the sublattices of a step.
+        self.step_barrier = context.Barrier(workers + 1)
+        phase_barrier = context.Barrier(workers)
+
+        bounds = np.linspace(0, n, workers + 1).astype(int).tolist()
+        self.processes = []
+        for number in range(workers):
+            process = context.Process(target = strip_worker, daemon = True, args = (
+                self.shm.name, n, bounds[number], bounds[number + 1], ca_eco.rules_with(rules), entropy, number,
+                phase_barrier, self.step_barrier))
+            process.start()
+            self.processes.append(process)
+
+    def step(self):
+        ''' Steps the world on by one generation. '''
+        self.step_barrier.wait()   # go
+        self.step_barrier.wait()   # done
+
+    def close(self):
+        ''' Stops the workers, and frees the world's shared memory; self.W goes with it. '''
+        self.stop[0] = 1
+        try:
+            self.step_barrier.wait()
+        except threading.BrokenBarrierError:
+            # A worker has failed; the rest are on their way out already.
+            pass
+        for process in self.processes:
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+        del self.W, self.stop
+        self.shm.close()
+        self.shm.unlink()
+
+
+def views(shm, n):
+    ''' The world, the critters yet to move, and the stop flag, in a DomainWorld's shared memory. '''
+    W = np.ndarray((n, n, 2), dtype = np.uint8, buffer = shm.buf)
+    pending = np.ndarray((n * n,), dtype = bool, buffer = shm.buf, offset = 2 * n * n)
+    stop = np.ndarray((1,), dtype = np.uint8, buffer = shm.buf, offset = 3 * n * n)
+    return W, pending, stop
+
+
+def strip_worker(name, n, top, bottom, rules, entropy, number, phase, step):
+    ''' The loop of one worker of a DomainWorld: waits at step to be told to go, steps rows top up
+        to bottom of the world in the shared memory called name on a generation, and waits at step
+        again to say it is done, until told to stop. '''
+    # Forked after the world was made, this process shares its creator's resource tracker, which
+    # lets go of it when the DomainWorld unlinks it.
+    shm = shared_memory.SharedMemory(name = name)
+    W, pending, stop = views(shm, n)
+
+    # The order of the sublattices is drawn alike in every strip; the rest is the strip's own.
+    order = np.random.default_rng(np.random.SeedSequence(entropy, spawn_key = (0,)))
+    rng = RandomSource(np.random.SeedSequence(entropy, spawn_key = (1 + number,)))
+    strip = Strip(W, pending, top, bottom, rules)
+    try:
+        while True:
+            step.wait()
+            if stop[0]:
+                break
+            strip.step(order, rng, phase)
+            step.wait()
+    except threading.BrokenBarrierError:
+        pass
+    except BaseException:
+        # Don't leave the others waiting for this one.
+        phase.abort()
+        step.abort()
+        raise
+    finally:
+        del W, pending, stop, strip
+        shm.close()
+
+
+class Strip:
+    ''' Rows top up to bottom of world W, for a worker of a DomainWorld to step on. '''
+
+    def __init__(self, W, pending, top, bottom, rules):
+        n = self.n = W.shape[0]
+        self.W = W
+        self.cells = W.reshape(n * n, 2)
+        self.pending = pending
+        self.top, self.bottom = top, bottom
+        self.rules = rules
+        # Which sublattice each cell of the strip is in; and the strip's rows, with the ones on
+        # either side of it.
+        lattices = ca_eco.sublattices(n, top, bottom)
+        self.lattices = len(lattices)
+        self.lattice_of = np.empty((bottom - top) * n, dtype = np.int8)
+        for s, lattice in enumerate(lattices):
+            self.lattice_of[lattice - top * n] = s
+        self.rows = np.arange(top - 1, bottom + 1) % n
+
+    def by_sublattice(self, marked):
+        ''' The cells a mask of the strip marks (bottom - top rows of n), by sublattice, each in
+            order. Phases go through these, not through every cell of every sublattice. '''
+        marked = np.flatnonzero(marked)
+        lattice = self.lattice_of[marked]
+        bounds = np.cumsum(np.bincount(lattice, minlength = self.lattices))[:-1]
+        return np.split(marked[np.argsort(lattice, kind = 'stable')] + self.top * self.n, bounds)
+
+    def near(self, marked):
+        ''' For each cell of the strip, whether it or one of its neighbors is marked by a mask of
+            the strip's rows and the ones on either side of it. '''
+        rows = marked[:-2] | marked[1:-1] | marked[2:]
+        return rows | np.roll(rows, 1, axis = 1) | np.roll(rows, -1, axis = 1)
+
+    def step(self, order, rng, phase):
+        ''' One generation of the strip, in step with the other strips, which it meets at the
+            barrier phase after each sublattice. order draws the order the sublattices go in. '''
+        n, cells, rules = self.n, self.cells, self.rules
+        strip = self.W[self.top:self.bottom]
+
+        # Every critter gets a move.
+        critters = ca_eco.KIND_OF_TYPE[strip[:, :, 0]] >= ca_eco.PREY
+        self.pending[self.top * n:self.bottom * n] = critters.ravel()
+        lattices = self.by_sublattice(critters)
+        phase.wait()
+        for s in order.permutation(self.lattices):
+            ca_eco.move_sublattice(self.W, lattices[s], self.pending, rules['prob_true_percept'],
+                                   rules['pred_feeding_fitness'], rules['prey_feeding_fitness'], rng)
+            phase.wait()
+
+        # Births: plants, prey, then predators. Only cells that are empty when a phase starts can
+        # have a birth in it, so each phase starts by finding them, and what else is needed to be
+        # sure of a birth there that will still be so when their sublattice's turn comes.
+        lattices = self.by_sublattice((strip[:, :, 0] == 0) & (strip[:, :, 1] > rules['space_fallow_time']))
+        for s in order.permutation(self.lattices):
+            grow_plants_sublattice(cells, lattices[s], n)
+            phase.wait()
+        for kind, birth_threshold, atbirth_fitness in (
+                (ca_eco.PREY, rules['prey_birth_threshold'], rules['prey_atbirth_fitness']),
+                (ca_eco.PRED, rules['pred_birth_threshold'], rules['pred_atbirth_fitness'])):
+            spaces = strip[:, :, 0] <= 1
+            if atbirth_fitness <= birth_threshold:
+                # Parents only lose fitness, and newborns are never fit to be parents in turn,
+                # so a birth needs a parent fit at the start.
+                around = self.W[self.rows]
+                fit = (ca_eco.KIND_OF_TYPE[around[:, :, 0]] == kind) & (around[:, :, 1] > birth_threshold)
+                spaces &= self.near(fit)
+            lattices = self.by_sublattice(spaces)
+            for s in order.permutation(self.lattices):
+                spawn_sublattice(cells, lattices[s], n, kind, birth_threshold, atbirth_fitness)
+                phase.wait()
+
+        # Deaths, which never touch more than the cell itself.
+        starve_and_age_strip(strip.reshape(-1, 2))
+
+
+def grow_plants_sublattice(cells, empty, n):
+    ''' Plant births on one sublattice (see ca_eco.grow_plants_reference): every cell of it in
+        empty (the ones that have lain fallow long enough) that is next to a plant grows one. '''
+    near = ca_eco.neighbor_cells(np.divmod(empty, n), n)
+    grown = empty[(cells[near, 0] == 1).any(axis = 1)]
+    cells[grown, 0] = 1
+    cells[grown, 1] = 0
+
+
+def spawn_sublattice(cells, spaces, n, kind, birth_threshold, atbirth_fitness):
+    ''' Births of prey (kind PREY) or predators (kind PRED) on one sublattice (see
+        ca_eco.spawn_reference): every empty or plant cell of it in spaces looks at its first
+        neighbor of that kind, which, if it has enough fitness, has a newborn of its own type there. '''
+    near = ca_eco.neighbor_cells(np.divmod(spaces, n), n)
+    is_parent = ca_eco.KIND_OF_TYPE[cells[near, 0]] == kind
+    first = near[np.arange(len(spaces)), is_parent.argmax(axis = 1)]
+    born = is_parent.any(axis = 1) & (cells[first, 1] > birth_threshold)
+    newborns, born_to = spaces[born], first[born]
+
+    # Birth, inheriting the parent's strategy, takes some of its energy.
+    cells[newborns, 0] = cells[born_to, 0]
+    cells[newborns, 1] = atbirth_fitness
+    cells[born_to, 1] -= atbirth_fitness
+
+
+def starve_and_age_strip(strip):
+    ''' Deaths in the cells of a strip (see ca_eco.starve_and_age). '''
+    kinds = ca_eco.KIND_OF_TYPE[strip[:, 0]]
+    strip[kinds == ca_eco.EMPTY, 1] += 1
+    critters = kinds >= ca_eco.PREY
+    starved = critters & (strip[:, 1] == 0)
+    strip[critters & ~starved, 1] -= 1
+    strip[starved] = 0
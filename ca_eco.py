@@ -1,13 +1,20 @@
 import numpy as np
-from numpy.random import rand, randint
-from copy import deepcopy
+from ca_random import RandomSource
+from ca_frames import FrameEncoder, PHASES, TYPES, encode_profile, encode_stats, max_frame_size
+from ca_ring import FrameRing, READY
+from ca_cache import ResultCache
+import ca_domain
+from time import perf_counter
 
 # Function to initialize a random world of 3 types of cells.
-def init_world(n, p, q):
+def init_world(n, p, q, rng=None):
     ''' Input n: the dimensions of the world is nxn
               p, q:  probability of types pred (P) and prey (H)  (cats and birds)
               All other cells are initialized as plants (V) 
+              rng: a numpy.random.Generator, pass a seeded one to reproduce a world
         Output: an initialized numpy array, with 1 for all type V, 2 for type H, and 3 for type P cells. '''
+    if rng is None:
+        rng = np.random.default_rng()
     
     # Initial fitness
     prey_atbirth_fitness = 2
@@ -15,316 +22,314 @@ def init_world(n, p, q):
     
     # This is our world.
     W = np.ones((n, n, 2), dtype = np.uint8)  # type V, plants everywhere
+    W[:, :, 1] = 0                            # fitness isn't used for plants
 
-    # Populate our world with cats and birds.
-    for i in range(n):
-        for j in range(n):
-            r = rand()
-            if r < p:
-                W[i, j, 0] = randint(5, 8)   # cats with random strategies in {5, 6, 7}
-                W[i, j, 1] = pred_atbirth_fitness
-            elif r < p + q:
-                W[i, j, 0] = randint(2, 5)   # birds with random strategies in {2, 3, 4}
-                W[i, j, 1] = prey_atbirth_fitness
-            else:
-                # It's already 1, for type V, plants.
-                W[i, j, 1] = 0
+    # Populate our world with cats and birds, drawing every cell's dice at once.
+    r = rng.random((n, n))
+    cats = r < p
+    birds = (r >= p) & (r < p + q)
+
+    W[cats, 0] = rng.integers(5, 8, size = np.count_nonzero(cats), dtype = np.uint8)    # cats with random strategies in {5, 6, 7}
+    W[cats, 1] = pred_atbirth_fitness
+    W[birds, 0] = rng.integers(2, 5, size = np.count_nonzero(birds), dtype = np.uint8)  # birds with random strategies in {2, 3, 4}
+    W[birds, 1] = prey_atbirth_fitness
     return W
 
 
-def fetch_critter_coords(W):
-    n = W.shape[0]
-    preds, prey = [], []
-    for i in range(n):
-        for j in range(n):
-            if 2 <= W[i, j, 0] <= 4:
-                prey.append((i, j))
-            elif 5 <= W[i, j, 0] <= 7:
-                preds.append((i, j))
-    return preds, prey
+# Kinds of cell, as tracked by CellIndex.
+EMPTY, PLANT, PREY, PRED = 0, 1, 2, 3
 
+# Kind of each cell type: 0 empty, 1 plant, 2-4 birds (prey), 5-7 cats (predators).
+CELL_KIND = (EMPTY, PLANT, PREY, PREY, PREY, PRED, PRED, PRED)
 
-def fetch_empty_coords(W):
-    n = W.shape[0]
-    empty = []
-    for i in range(n):
-        for j in range(n):
-            if W[i, j, 0] == 0:
-                empty.append((i, j))
-    return empty
 
+class CellIndex:
+    ''' Flat positions (i * n + j) of the empty, plant, prey and predator cells of a world.
+        Each kind is kept in its own array, and every cell remembers its slot in that array,
+        so a cell changing kind costs O(1) and no step has to rescan the whole grid. '''
 
-def fetch_empty_or_plant_coords(W):
-    n = W.shape[0]
-    empty = []
-    for i in range(n):
-        for j in range(n):
-            if W[i, j, 0] in {0, 1}:
-                empty.append((i, j))
-    return empty
+    def __init__(self, W, order=None):
+        n = W.shape[0]
+        self.n = n
+        self.slot = np.zeros(n * n, dtype = np.int32)   # slot of each cell in its kind's array
+        self.rebuild(W, order)
 
+        # Marks the critters that still have a move to make this step (see CritterQueue).
+        self.pending = np.zeros(n * n, dtype = bool)
 
-def find_nearby_prey(coords, W):
-    n = W.shape[0]
-    i, j = coords
-    near_prey = []
-    for k in {-1, 0, 1}:
-        for l in {-1, 0, 1}:
-            if k != 0 or l != 0:
-                I, J = (i + k) % n,  (j + l) % n
-                if 2 <= W[I, J, 0] <= 4:
-                    near_prey.append((I, J))
-    return near_prey
+    def rebuild(self, W, order=None):
+        ''' Index the whole world again, in bulk; cheaper than retype after most cells have changed.
+            The cells of each kind go in order of position, or in the order given (see order). '''
+        if order is None:
+            kinds = np.array(CELL_KIND, dtype = np.uint8)[W[:, :, 0]].ravel()
+            order = [np.flatnonzero(kinds == kind) for kind in (EMPTY, PLANT, PREY, PRED)]
+        self.cells, self.counts = [], []
+        for cells in order:
+            cells = np.asarray(cells, dtype = np.int32)
+            self.slot[cells] = np.arange(len(cells), dtype = np.int32)
+            self.cells.append(np.resize(cells, max(2 * len(cells), 16)))
+            self.counts.append(len(cells))
 
+    def order(self):
+        ''' The cells of each kind in the order they are kept. Critters take turns in an order
+            shuffled from this one, so carrying on a run exactly needs it (see rebuild). '''
+        return [self.of(kind).copy() for kind in (EMPTY, PLANT, PREY, PRED)]
 
-def find_nearby_preds(coords, W):
-    n = W.shape[0]
-    i, j = coords
-    near_preds = []
-    for k in {-1, 0, 1}:
-        for l in {-1, 0, 1}:
-            if k != 0 or l != 0:
-                I, J = (i + k) % n,  (j + l) % n
-                if 5 <= W[I, J, 0] <= 7:
-                    near_preds.append((I, J))
-    return near_preds
+    def of(self, kind):
+        ''' The flat positions of all cells of a kind (a view, copy it before changing cells). '''
+        return self.cells[kind][:self.counts[kind]]
 
+    def retype(self, cell, old_type, new_type):
+        ''' Record that the cell at flat position cell changes from old_type to new_type. '''
+        old, new = CELL_KIND[old_type], CELL_KIND[new_type]
+        if old == new:
+            return
 
-def find_nearby_plants(coords, W):
-    n = W.shape[0]
+        # Take it out of its old array, filling the gap with the last entry.
+        s, last = self.slot[cell], self.counts[old] - 1
+        tail = self.cells[old][last]
+        self.cells[old][s] = tail
+        self.slot[tail] = s
+        self.counts[old] = last
+
+        # And append it to its new one, growing that if it is full.
+        k = self.counts[new]
+        if k == len(self.cells[new]):
+            self.cells[new] = np.resize(self.cells[new], 2 * k)
+        self.cells[new][k] = cell
+        self.slot[cell] = k
+        self.counts[new] = k + 1
+
+    def update(self, W, cells):
+        ''' Record that the cells at flat positions cells (each once) may have changed kind, to
+            whatever they are in W now, in bulk. Costs as much as the cells given, not the world. '''
+        kinds = KIND_OF_TYPE[W.reshape(self.n * self.n, 2)[cells, 0]]
+
+        # The kind each was before: the one whose array has it at its slot.
+        slots = self.slot[cells]
+        was = np.empty_like(kinds)
+        for kind in (EMPTY, PLANT, PREY, PRED):
+            was[(self.cells[kind].take(slots, mode = 'clip') == cells) & (slots < self.counts[kind])] = kind
+
+        changed = kinds != was
+        cells, kinds, was = cells[changed], kinds[changed], was[changed]
+        for kind in (EMPTY, PLANT, PREY, PRED):
+            self.take_out(kind, cells[was == kind])
+        for kind in (EMPTY, PLANT, PREY, PRED):
+            self.put_in(kind, cells[kinds == kind])
+
+    def take_out(self, kind, cells):
+        ''' Takes cells out of kind's array, filling the gaps with its last entries. '''
+        count = self.counts[kind] - len(cells)
+        slots = self.slot[cells]
+        # The last len(cells) entries fill the gaps below them, unless they are going too.
+        staying = np.ones(len(cells), dtype = bool)
+        staying[slots[slots >= count] - count] = False
+        tail = self.cells[kind][count:self.counts[kind]][staying]
+        gaps = slots[slots < count]
+        self.cells[kind][gaps] = tail
+        self.slot[tail] = gaps
+        self.counts[kind] = count
+
+    def put_in(self, kind, cells):
+        ''' Appends cells to kind's array, growing that if they don't fit. '''
+        start, count = self.counts[kind], self.counts[kind] + len(cells)
+        if count > len(self.cells[kind]):
+            self.cells[kind] = np.resize(self.cells[kind], 2 * count)
+        self.cells[kind][start:count] = cells
+        self.slot[cells] = np.arange(start, count, dtype = np.int32)
+        self.counts[kind] = count
+
+
+class CritterQueue:
+    ''' The order in which one kind of critter takes its turn this step.
+        Critters that get eaten lose their turn; that is an O(1) discard, not a list search. '''
+
+    def __init__(self, cells, pending):
+        self.cells = cells.tolist()
+        self.pending = pending
+        self.pending[cells] = True
+        self.count = len(self.cells)
+
+    def __len__(self):
+        return self.count
+
+    def pop(self):
+        ''' The flat position of the next critter to move. '''
+        while True:
+            cell = self.cells.pop()
+            if self.pending[cell]:
+                self.pending[cell] = False
+                self.count -= 1
+                return cell
+
+    def discard(self, cell):
+        ''' The critter at this flat position has been eaten, skip its turn. '''
+        if self.pending[cell]:
+            self.pending[cell] = False
+            self.count -= 1
+
+
+def set_cell(coords, cell_type, fitness, W, index):
+    ''' Write a cell of the world, keeping the position index up to date. '''
+    I, J = coords
+    index.retype(I * index.n + J, W[I, J, 0], cell_type)
+    W[I, J, 0] = cell_type
+    W[I, J, 1] = fitness
+
+
+# Offsets of the 8 neighbors of a cell, in the order the world has always visited them.
+NEIGHBOR_OFFSETS = [(k, l) for k in (0, 1, -1) for l in (0, 1, -1) if k != 0 or l != 0]
+
+# Neighbor tables, computed once per world size.
+_neighbor_tables = {}
+
+def neighbor_tables(n):
+    ''' Returns (rows, cols) for an nxn torus, with the % n wrap-around already done.
+        rows[i][m] + cols[j][m] is where the type of neighbor m of cell (i, j) sits in W.ravel(),
+        i.e. twice its flat position, since each cell holds a type and a fitness. '''
+    if n not in _neighbor_tables:
+        rows = [[((i + k) % n) * n * 2 for k, l in NEIGHBOR_OFFSETS] for i in range(n)]
+        cols = [[(j + l) % n * 2 for k, l in NEIGHBOR_OFFSETS] for j in range(n)]
+        _neighbor_tables[n] = (np.array(rows, dtype = np.intp), np.array(cols, dtype = np.intp))
+    return _neighbor_tables[n]
+
+
+def neighbor_cells(coords, n):
+    ''' The flat positions of the 8 neighbors of the cell at coords. '''
+    rows, cols = neighbor_tables(n)
     i, j = coords
-    near_plants = []
-    for k in {-1, 0, 1}:
-        for l in {-1, 0, 1}:
-            if k != 0 or l != 0:
-                I, J = (i + k) % n,  (j + l) % n
-                if W[I, J, 0] == 1:
-                    near_plants.append((I, J))
-    return near_plants
-
-
-# This function looks for empty spaces or plants.
-def find_nearby_spaces_or_plants(coords, W):
-    n = W.shape[0]
+    return (rows[i] + cols[j]) >> 1
+
+
+def neighborhood(coords, W):
+    ''' Looks at all 8 neighbors of the cell at coords in a single gather and sorts them by kind.
+        Returns a list indexed by EMPTY, PLANT, PREY and PRED, each a list of flat positions. '''
+    rows, cols = neighbor_tables(W.shape[0])
     i, j = coords
-    near_spaces = []
-    for k in {-1, 0, 1}:
-        for l in {-1, 0, 1}:
-            if k != 0 or l != 0:
-                I, J = (i + k) % n,  (j + l) % n
-                if W[I, J, 0] == 0 or W[I, J, 0] == 1:
-                    near_spaces.append((I, J))
-    return near_spaces
-
-
-# This function looks for empty spaces.
-def find_nearby_space(this_prey_coords, W):
-    n = W.shape[0]
-    i, j = this_prey_coords
-    near_spaces = []
-    for k in {-1, 0, 1}:
-        for l in {-1, 0, 1}:
-            if k != 0 or l != 0:
-                I, J = (i + k) % n,  (j + l) % n
-                if W[I, J, 0] == 0 :
-                    near_spaces.append((I, J))
-    return near_spaces
-    
+    near = rows[i] + cols[j]
+    by_kind = ([], [], [], [])
+    for at, cell_type in zip(near.tolist(), W.reshape(-1)[near].tolist()):
+        by_kind[CELL_KIND[cell_type]].append(at >> 1)
+    return by_kind
+
+
+# Escape routes: for a predator at neighbor offset m, the neighbors of the prey that are not adjacent to it.
+ESCAPE_ROUTES = [[e for e, (k, l) in enumerate(NEIGHBOR_OFFSETS) if max(abs(k - a), abs(l - b)) > 1]
+                 for a, b in NEIGHBOR_OFFSETS]
+
+# The same as a table: ESCAPE_TABLE[m, e] is True if neighbor e is an escape from a predator at m.
+# The extra last row (no escapes) is for a "predator" that isn't adjacent at all.
+ESCAPE_TABLE = np.array([[e in routes for e in range(8)] for routes in ESCAPE_ROUTES] + [[False] * 8])
+
+# Which neighbor an offset (a, b) is, looked up with [a + 1, b + 1]; the cell itself maps to the last row above.
+OFFSET_SLOT = np.full((3, 3), 8, dtype = np.intp)
+for m, (k, l) in enumerate(NEIGHBOR_OFFSETS):
+    OFFSET_SLOT[k + 1, l + 1] = m
+
 
 def move_away(move_from, away_from, W):
     ''' Prey is at move_from coords, and predator is at away_from, and the prey 
         naturally wishes to get away to a cell that's not adjacent to the predator.
-        This function returns a list of safe spaces that the prey can move to.'''
+        This function returns a list of safe spaces (empty or plant) that the prey can move to.'''
     i, j = move_from   # prey at (i, j)
     I, J = away_from   # predator at (I, J)
-   
+
     n = W.shape[0]
-    a, b = (I - i) % n, (J - j) % n
-    
-    escapes = []
-    if a == n - 1 and b == n - 1:  # n - 1 == -1 mod n
-        inew, jnew = (i + 1) % n, (j + 1) % n
-        if W[inew, jnew, 0] in {0, 1}: 
-            escapes.append((inew, jnew))
-        inew, jnew = (i + 1) % n, j
-        if W[inew, jnew, 0] in {0, 1}: 
-            escapes.append((inew, jnew))
-        inew, jnew = i, (j + 1) % n
-        if W[inew, jnew, 0] in {0, 1}: 
-            escapes.append((inew, jnew))
-        inew, jnew = (i + 1) % n, (j - 1) % n
-        if W[inew, jnew, 0] in {0, 1}: 
-            escapes.append((inew, jnew))
-        inew, jnew = (i - 1) % n, (j + 1) % n
-        if W[inew, jnew, 0] in {0, 1}: 
-            escapes.append((inew, jnew))
-        return escapes
-        
-    if a == 0 and b == n - 1:  # n - 1 == -1 mod n
-        inew, jnew = i, (j + 1) % n
-        if W[inew, jnew, 0] in {0, 1}: 
-            escapes.append((inew, jnew))
-        inew, jnew = (i - 1) % n, (j + 1) % n
-        if W[inew, jnew, 0] in {0, 1}: 
-            escapes.append((inew, jnew))
-        inew, jnew = (i + 1) % n, (j + 1) % n
-        if W[inew, jnew, 0] in {0, 1}: 
-            escapes.append((inew, jnew))
-        return escapes
-        
-    if a == 1 and b == n - 1:  # n - 1 == -1 mod n
-        inew, jnew = (i - 1) % n, (j + 1) % n
-        if W[inew, jnew, 0] in {0, 1}: 
-            escapes.append((inew, jnew))
-        inew, jnew = (i - 1) % n, j
-        if W[inew, jnew, 0] in {0, 1}: 
-            escapes.append((inew, jnew))
-        inew, jnew = i, (j + 1) % n
-        if W[inew, jnew, 0] in {0, 1}: 
-            escapes.append((inew, jnew))
-        inew, jnew = (i - 1) % n, (j - 1) % n
-        if W[inew, jnew, 0] in {0, 1}: 
-            escapes.append((inew, jnew))
-        inew, jnew = (i + 1) % n, (j + 1) % n
-        if W[inew, jnew, 0] in {0, 1}: 
-            escapes.append((inew, jnew))
-        return escapes
-        
-    if a == n - 1 and b == 0:  # n - 1 == -1 mod n
-        inew, jnew = (i + 1) % n, j
-        if W[inew, jnew, 0] in {0, 1}: 
-            escapes.append((inew, jnew))
-        inew, jnew = (i + 1) % n, (j - 1) % n
-        if W[inew, jnew, 0] in {0, 1}: 
-            escapes.append((inew, jnew))
-        inew, jnew = (i + 1) % n, (j + 1) % n
-        if W[inew, jnew, 0] in {0, 1}: 
-            escapes.append((inew, jnew))
-        return escapes
-        
-    if a == 1 and b == 0:  
-        inew, jnew = (i - 1) % n, j
-        if W[inew, jnew, 0] in {0, 1}: 
-            escapes.append((inew, jnew))
-        inew, jnew = (i - 1) % n, (j - 1) % n
-        if W[inew, jnew, 0] in {0, 1}: 
-            escapes.append((inew, jnew))
-        inew, jnew = (i - 1) % n, (j + 1) % n
-        if W[inew, jnew, 0] in {0, 1}: 
-            escapes.append((inew, jnew))
-        return escapes
-        
-    if a == n - 1 and b == 1:  # n - 1 == -1 mod n
-        inew, jnew = (i + 1) % n, (j - 1) % n
-        if W[inew, jnew, 0] in {0, 1}: 
-            escapes.append((inew, jnew))
-        inew, jnew = i, (i - 1) % n
-        if W[inew, jnew, 0] in {0, 1}: 
-            escapes.append((inew, jnew))
-        inew, jnew = (i + 1) % n, j
-        if W[inew, jnew, 0] in {0, 1}: 
-            escapes.append((inew, jnew))
-        inew, jnew = (i - 1) % n, (j - 1) % n
-        if W[inew, jnew, 0] in {0, 1}: 
-            escapes.append((inew, jnew))
-        inew, jnew = (i + 1) % n, (j + 1) % n
-        if W[inew, jnew, 0] in {0, 1}: 
-            escapes.append((inew, jnew))
-        return escapes
-        
-    if a == 0 and b == 1:  
-        inew, jnew = i, (j - 1) % n
-        if W[inew, jnew, 0] in {0, 1}: 
-            escapes.append((inew, jnew))
-        inew, jnew = (i - 1) % n, (j - 1) % n
-        if W[inew, jnew, 0] in {0, 1}: 
-            escapes.append((inew, jnew))
-        inew, jnew = (i + 1) % n, (j - 1) % n
-        if W[inew, jnew, 0] in {0, 1}: 
-            escapes.append((inew, jnew))
-        return escapes
-        
-    if a == 1 and b == 1:
-        inew, jnew = (i - 1) % n, (j - 1) % n
-        if W[inew, jnew, 0] in {0, 1}: 
-            escapes.append((inew, jnew))
-        inew, jnew = i, (i - 1) % n
-        if W[inew, jnew, 0] in {0, 1}: 
-            escapes.append((inew, jnew))
-        inew, jnew = (i - 1) % n, j
-        if W[inew, jnew, 0] in {0, 1}: 
-            escapes.append((inew, jnew))
-        inew, jnew = (i + 1) % n, (j - 1) % n
-        if W[inew, jnew, 0] in {0, 1}: 
-            escapes.append((inew, jnew))
-        inew, jnew = (i - 1) % n, (j + 1) % n
-        if W[inew, jnew, 0] in {0, 1}: 
-            escapes.append((inew, jnew))
-        return escapes
-    
-    # Nowhere to go.
-    return escapes
+    a, b = (I - i + 1) % n, (J - j + 1) % n   # offset to the predator, plus 1
 
+    # Nowhere to go, if it isn't next to us.
+    if a > 2 or b > 2:
+        return []
 
+    # Look up the escape routes, and check them all in one go.
+    rows, cols = neighbor_tables(n)
+    near = (rows[i] + cols[j])[ESCAPE_ROUTES[OFFSET_SLOT[a, b]]]
+    return [divmod(at >> 1, n) for at, cell_type in zip(near.tolist(), W.reshape(-1)[near].tolist())
+            if cell_type <= 1]
+
+
+def move_away_batch(move_from, away_from, W):
+    ''' move_away for many prey at once. move_from and away_from are arrays of the flat positions
+        of each prey and the predator it is fleeing. Returns (escapes, safe), both shaped (len, 8):
+        the flat positions of each prey's neighbors, and which of them are safe spaces to move to.'''
+    n = W.shape[0]
+    i, j = np.divmod(move_from, n)
+    I, J = np.divmod(away_from, n)
+    a, b = (I - i + 1) % n, (J - j + 1) % n   # offsets to the predators, plus 1
+
+    # A "predator" that isn't next to its prey gives no escapes.
+    adjacent = (a <= 2) & (b <= 2)
+    slots = np.full(len(a), 8, dtype = np.intp)
+    slots[adjacent] = OFFSET_SLOT[a[adjacent], b[adjacent]]
+
+    rows, cols = neighbor_tables(n)
+    near = rows[i] + cols[j]
+    safe = ESCAPE_TABLE[slots] & (W.reshape(-1)[near] <= 1)
+    return near >> 1, safe
+
+
+
+def find_prey(this_pred_coords, prey, pred_feeding_fitness, W, index, rng):
 
-def find_prey(this_pred_coords, prey, pred_feeding_fitness, W):
-    
     i, j = this_pred_coords
-    
+    n = W.shape[0]
+
+    # Look around once; the lists below are all taken from this.
+    near = neighborhood(this_pred_coords, W)
+
     # If any prey around, pick one at random and eat it.
-    nearby_prey = find_nearby_prey(this_pred_coords, W)
+    nearby_prey = near[PREY]
     if len(nearby_prey) > 0:
-        I, J = nearby_prey[randint(0, len(nearby_prey))]
-        if (I, J) in prey:
-            prey.pop(prey.index((I, J))) # the poor thing's been eaten
-            
+        eaten = nearby_prey[rng.randint(0, len(nearby_prey))]
+        I, J = divmod(eaten, n)
+        prey.discard(eaten) # the poor thing's been eaten
+
         # This prey replaced by this preditor (which has eaten it).
-        W[I, J, 0] = W[i, j, 0]
-        W[I, J, 1] = W[i, j, 1] + pred_feeding_fitness
-        W[i, j, 0] = 1   # a plant remains behind
-        W[i, j, 1] = 0   # not used, for a plant 
-           
+        set_cell((I, J), W[i, j, 0], W[i, j, 1] + pred_feeding_fitness, W, index)
+        set_cell((i, j), 1, 0, W, index)   # a plant remains behind (fitness not used, for a plant)
+
     else:
         # If any nearby spaces, pick one at random to move to.
-        nearby_spaces = find_nearby_spaces_or_plants(this_pred_coords, W)
+        nearby_spaces = near[EMPTY] + near[PLANT]
         if len(nearby_spaces) > 0:
-            I, J = nearby_spaces[randint(0, len(nearby_spaces))]
-            
+            I, J = divmod(nearby_spaces[rng.randint(0, len(nearby_spaces))], n)
+
             # Space or plant replaced by this preditor (which has moved here).
-            W[I, J, 0] = W[i, j, 0]
-            W[I, J, 1] = W[i, j, 1]
-            W[i, j, 0] = 1   # a plant remains behind
-            W[i, j, 1] = 0   # not used, for a plant
-            
+            set_cell((I, J), W[i, j, 0], W[i, j, 1], W, index)
+            set_cell((i, j), 1, 0, W, index)   # a plant remains behind (fitness not used, for a plant)
+
     return W, prey
 
 
 
-def find_pred(this_prey_coords, preds, prey_feeding_fitness, W):
-    
+def find_pred(this_prey_coords, preds, prey_feeding_fitness, W, index, rng):
+
     i, j = this_prey_coords
+    n = W.shape[0]
 
-    # These lists will be used below.
-    nearby_preds = find_nearby_preds(this_prey_coords, W)
-    nearby_plants = find_nearby_plants(this_prey_coords, W)
-    nearby_space = find_nearby_space(this_prey_coords, W)
+    # These lists will be used below, all from one look around.
+    near = neighborhood(this_prey_coords, W)
+    nearby_preds = near[PRED]
+    nearby_plants = near[PLANT]
+    nearby_space = near[EMPTY]
 
     # If any preds around, try to escape.
     if len(nearby_preds) > 0:
-        
+
         # Pick a random nearby pred and move away from it!
-        this_pred_coords = nearby_preds[randint(0, len(nearby_preds))]
+        this_pred_coords = divmod(nearby_preds[rng.randint(0, len(nearby_preds))], n)
 
         # If any nearby spaces, pick one at random to move to.
         move_to = move_away(this_prey_coords, this_pred_coords, W)
 
         # If there's anywhere to move to...
         if len(move_to) > 0:
-            
+
             # Pick an available cell to escape to.
-            I, J = move_to[randint(0, len(move_to))]
+            I, J = move_to[rng.randint(0, len(move_to))]
 
-            if W[I, J, 0] == 1:  
+            if W[I, J, 0] == 1:
                 # If a plant is here, might as well eat it!
                 eat_a_plant = prey_feeding_fitness
             else:
@@ -332,334 +337,889 @@ def find_pred(this_prey_coords, preds, prey_feeding_fitness, W):
                 eat_a_plant = 0
 
             # Space or plant replaced by this prey (which has moved here).
-            W[I, J, 0] = W[i, j, 0]
-            W[I, J, 1] = W[i, j, 1] + eat_a_plant
-            W[i, j, 0] = 0   # empty space, now that this cell is vacated
-            W[i, j, 1] = 0   # and a new empty space, at that
+            set_cell((I, J), W[i, j, 0], W[i, j, 1] + eat_a_plant, W, index)
+            set_cell((i, j), 0, 0, W, index)   # a new empty space, now that this cell is vacated
 
-    # Else if any plants, go eat one.         
+    # Else if any plants, go eat one.
     elif len(nearby_plants) > 0:
         # Pick a random nearby plant and go eat it!
-        I, J = nearby_plants[randint(0, len(nearby_plants))]
+        I, J = divmod(nearby_plants[rng.randint(0, len(nearby_plants))], n)
 
         # Plant replaced by this prey (which has eaten it).
-        W[I, J, 0] = W[i, j, 0]
-        W[I, J, 1] = W[i, j, 1] + prey_feeding_fitness
-        W[i, j, 0] = 0  # empty space, now that this cell is vacated
-        W[i, j, 1] = 0  # new empty space
+        set_cell((I, J), W[i, j, 0], W[i, j, 1] + prey_feeding_fitness, W, index)
+        set_cell((i, j), 0, 0, W, index)   # new empty space, now that this cell is vacated
 
     # Else move to empty space, if possible.
     elif len(nearby_space) > 0:
         # If any nearby empty spaces, pick one at random to move to.
-        I, J = nearby_space[randint(0, len(nearby_space))]
+        I, J = divmod(nearby_space[rng.randint(0, len(nearby_space))], n)
 
         # Empty space replaced by this prey (which has moved there).
-        W[I, J, 0] = W[i, j, 0]
-        W[I, J, 1] = W[i, j, 1]
-        W[i, j, 0] = 0  # empty space, now that this cell is vacated
-        W[i, j, 1] = 0  # when incremented to space_fallow_time, eligible for new plant
-        
+        set_cell((I, J), W[i, j, 0], W[i, j, 1], W, index)
+        set_cell((i, j), 0, 0, W, index)   # when incremented to space_fallow_time, eligible for new plant
+
     return W, preds
 
 
 
-def blind_cat_move(this_pred_coords, prey, pred_feeding_fitness, W):
-    
+def blind_cat_move(this_pred_coords, prey, pred_feeding_fitness, W, index, rng):
+
     # Make a list of all possible moves.
     i, j = this_pred_coords
     n = W.shape[0]
-    to_be_explored = []
-    for k in range(-1, 2):
-        for l in range(-1, 2):
-            if k != 0 or l != 0:
-                I, J = (i + k) % n, (j + l) % n
-                to_be_explored.append((I, J))
-    
+    to_be_explored = neighbor_cells(this_pred_coords, n)
+
     # Shuffle the possible moves.
-    np.random.shuffle(to_be_explored)
-    
-    # While more moves to explore...
-    while len(to_be_explored) > 0:
-        I, J = to_be_explored.pop()
-        
+    rng.shuffle(to_be_explored)
+
+    # Look at all of them at once, then explore them in that order.
+    explored_types = W.reshape(-1, 2)[to_be_explored, 0]
+    for cell, cell_type in zip(to_be_explored.tolist(), explored_types.tolist()):
+        I, J = divmod(cell, n)
+
         # If the cell is empty or a plant...
-        if W[I, J, 0] in {0, 1}:
-            
+        if cell_type in {0, 1}:
+
             # Move into this empty (or plant) cell.
-            W[I, J, 0] = W[i, j, 0]
-            W[I, J, 1] = W[i, j, 1]
-            W[i, j, 0] = 1   # a plant
-            W[i, j, 1] = 0   # unused for plants
+            set_cell((I, J), W[i, j, 0], W[i, j, 1], W, index)
+            set_cell((i, j), 1, 0, W, index)   # a plant (fitness unused for plants)
             return W, prey
-        
+
         # If the cell is a cat...
-        elif W[I, J, 0] > 4:
+        elif cell_type > 4:
             continue    # another cat occupies that cell
-        
+
         # The cell is a bird...
         else:
             # The cat gets to eat.
-            if (I, J) in prey:
-                prey.pop(prey.index((I, J))) # the poor thing's been eaten
-                
+            prey.discard(cell) # the poor thing's been eaten
+
             # This prey replaced by this preditor (which has eaten it).
-            W[I, J, 0] = W[i, j, 0]
-            W[I, J, 1] = W[i, j, 1] + pred_feeding_fitness
-            W[i, j, 0] = 1   # a plant
-            W[i, j, 1] = 0   # unused for plants
+            set_cell((I, J), W[i, j, 0], W[i, j, 1] + pred_feeding_fitness, W, index)
+            set_cell((i, j), 1, 0, W, index)   # a plant (fitness unused for plants)
             return W, prey
-            
-    return W, prey 
+
+    return W, prey
 
 
-def blind_bird_move(this_pred_coords, preds, prey, pred_feeding_fitness, prey_feeding_fitness, W):
-    
+def blind_bird_move(this_prey_coords, preds, prey, pred_feeding_fitness, prey_feeding_fitness, W, index, rng):
+
     # Make a list of all possible moves.
-    i, j = this_pred_coords
+    i, j = this_prey_coords
     n = W.shape[0]
-    to_be_explored = []
-    for k in range(-1, 2):
-        for l in range(-1, 2):
-            if k != 0 or l != 0:
-                I, J = (i + k) % n, (j + l) % n
-                to_be_explored.append((I, J))
+    to_be_explored = neighbor_cells(this_prey_coords, n)
     # Shuffle the possible moves.
-    np.random.shuffle(to_be_explored)
-    
-    # While more moves to explore...
-    while len(to_be_explored) > 0:
-        I, J = to_be_explored.pop()
-        
+    rng.shuffle(to_be_explored)
+
+    # Look at all of them at once, then explore them in that order.
+    explored_types = W.reshape(-1, 2)[to_be_explored, 0]
+    for cell, cell_type in zip(to_be_explored.tolist(), explored_types.tolist()):
+        I, J = divmod(cell, n)
+
         # If this space is empty...
-        if W[I, J, 0] == 0:
+        if cell_type == 0:
             # Move into this empty cell.
-            W[I, J, 0] = W[i, j, 0]
-            W[I, J, 1] = W[i, j, 1]
-            W[i, j, 0] = 0   # empty space
-            W[i, j, 1] = 0   # initial value for empty space
+            set_cell((I, J), W[i, j, 0], W[i, j, 1], W, index)
+            set_cell((i, j), 0, 0, W, index)   # empty space, with its initial value
             return W, preds, prey
-        
+
         # If this cell is occupied by another bird..
-        elif 2 <= W[I, J, 0] <= 4:
+        elif 2 <= cell_type <= 4:
             continue    # another bird occupies that cell
-            
+
         # If this cell holds a plant, the bird gets to eat it.
-        elif W[I, J, 0] == 1:
+        elif cell_type == 1:
             # This plant replaced by this bird (which has eaten it).
-            W[I, J, 0] = W[i, j, 0]
-            W[I, J, 1] = W[i, j, 1] + prey_feeding_fitness
-            W[i, j, 0] = 0   # empty space
-            W[i, j, 1] = 0   # initial value for empty space            
+            set_cell((I, J), W[i, j, 0], W[i, j, 1] + prey_feeding_fitness, W, index)
+            set_cell((i, j), 0, 0, W, index)   # empty space, with its initial value
             return W, preds, prey
-        
+
         # The cell hides a cat!  OOPs, the bird gets eaten.
         else:
-            if (i, j) in prey:
-                prey.pop(prey.index(this_prey)) # the poor thing's been eaten
             W[I, J, 1] += pred_feeding_fitness
-            W[i, j, 0] = 0   # empty space
-            W[i, j, 1] = 0   # initial value for empty space
-            
-    return W, preds, prey 
+            set_cell((i, j), 0, 0, W, index)   # empty space, with its initial value
+            return W, preds, prey
 
+    return W, preds, prey
 
 
-# Function to compute next generation.
-def time_step(W):
-    ''' Update the state of the world by one time step.'''
-    
-    # Constants:  2 2 3 10 6 2 3 leads to extinction
-    # Parameters defining the biologic parameters defining the ceatures' properties.
-    prey_atbirth_fitness = 3 
-    pred_atbirth_fitness = 5
-    prey_birth_threshold = 9
-    pred_birth_threshold = 13
-    prey_feeding_fitness = 2 
-    pred_feeding_fitness = 4
-    space_fallow_time = 3    # number of iterations before empty space can grow a new plant
-    prob_true_percept = 0.9  # probability of veridical perception
-    
-    # The dimensions of the world are nxn.
+
+# Kind of each cell type, for looking up whole arrays of types at once.
+KIND_OF_TYPE = np.array(CELL_KIND, dtype = np.uint8)
+
+# Offsets of the 24 cells within 2 of a cell; two births this close can influence each other.
+WINDOW_OFFSETS = [(k, l) for k in range(-2, 3) for l in range(-2, 3) if k != 0 or l != 0]
+
+
+def window_cells(cells, n):
+    ''' The flat positions of the 24 cells within 2 of each of an array of cells, shaped (len, 24). '''
+    i, j = np.divmod(cells, n)
+    k, l = np.array(WINDOW_OFFSETS).T
+    return ((i[:, None] + k) % n) * n + (j[:, None] + l) % n
+
+
+def lookup(cells, where):
+    ''' Finds where in the sorted array cells each of the positions in where is.
+        Returns (slots, found); slots is only meaningful where found is True. '''
+    slots = np.minimum(np.searchsorted(cells, where), len(cells) - 1)
+    return slots, cells[slots] == where
+
+
+def grow_plants_reference(W, index, space_fallow_time, rng):
+    ''' Plant births, visiting the empty cells one at a time in random order. '''
     n = W.shape[0]
-    
-    # Fetch lists of the coordinates of all the predators and prey.
-    preds, prey = fetch_critter_coords(W)
-    np.random.shuffle(preds)
-    np.random.shuffle(prey)
-    
-    # We need as many episodes as we have critters. 
+
+    # Fetch the positions of all the empty cells, from the index.
+    empty = index.of(EMPTY).copy()
+    rng.shuffle(empty)
+
+    # We need as many episodes as we have empty cells.
+    for this_space in empty.tolist():
+        # Pick a random empty space.
+        this_space = divmod(this_space, n)
+        nearby_plants = neighborhood(this_space, W)[PLANT]
+        if (len(nearby_plants) > 0) and (W[this_space[0], this_space[1], 1] > space_fallow_time):
+            set_cell(this_space, 1, 0, W, index)   # a new plant
+
+
+def grow_plants(W, index, space_fallow_time, rng):
+    ''' Plant births, for all empty cells at once.
+        Each empty cell gets a random turn, as in grow_plants_reference, and a new plant
+        helps a neighbor only if the neighbor's turn comes later; so the outcomes have
+        the same distribution as visiting the cells one at a time. '''
+    n = W.shape[0]
+    cells = W.reshape(n * n, 2)
+
+    # Only cells that have been empty long enough can grow a plant.
+    empty = index.of(EMPTY)
+    fallow = np.sort(empty[cells[empty, 1] > space_fallow_time])
+    if len(fallow) == 0:
+        return
+    turn = rng.permutation(len(fallow))
+
+    near = neighbor_cells(np.divmod(fallow, n), n)
+    slots, near_fallow = lookup(fallow, near)
+
+    # Next to a plant already: it grows whenever its turn comes.
+    grown = (cells[near, 0] == 1).any(axis = 1)
+
+    # Next to a cell that grew a plant on an earlier turn: it grows too. Repeat until nothing changes.
+    while True:
+        grown_turn = np.where(grown, turn, len(fallow))
+        earliest = np.where(near_fallow, grown_turn[slots], len(fallow)).min(axis = 1)
+        newly = ~grown & (earliest < turn)
+        if not newly.any():
+            break
+        grown |= newly
+
+    for this_space in fallow[grown].tolist():
+        set_cell(divmod(this_space, n), 1, 0, W, index)   # a new plant
+
+
+def spawn_reference(W, index, kind, birth_threshold, atbirth_fitness, rng):
+    ''' Births of prey (kind PREY) or predators (kind PRED), visiting the empty or plant
+        cells one at a time in random order. Each looks only at its first neighbor of that kind. '''
+    n = W.shape[0]
+
+    # Fetch the positions of all the empty cells or plant cells.
+    empty = np.concatenate((index.of(EMPTY), index.of(PLANT)))
+    rng.shuffle(empty)
+
+    # We need as many episodes as we have empty cells.
+    for this_space in empty.tolist():
+        # Pick a random empty space.
+        this_space = divmod(this_space, n)
+        nearby_parents = neighborhood(this_space, W)[kind]
+
+        # Do any of the nearby critters have enough fitness to spawn?
+        for parent in nearby_parents:
+            I, J = divmod(parent, n)
+            if W[I, J, 1] > birth_threshold:
+                # Birth
+                set_cell(this_space, W[I, J, 0], atbirth_fitness, W, index)   # inherit parent's strategy
+                # Birth takes some energy.
+                W[I, J, 1] -= atbirth_fitness
+            break
+
+
+def spawn(W, index, kind, birth_threshold, atbirth_fitness, rng):
+    ''' Births of prey (kind PREY) or predators (kind PRED), in batches.
+        Every empty or plant cell gets a random turn, as in spawn_reference. A batch is made
+        of the cells whose turn comes before that of any waiting cell within 2 of them; such
+        cells can't see each other's newborns or share a parent, so they are free of conflicts,
+        and the outcomes have the same distribution as visiting the cells one at a time. '''
+    n = W.shape[0]
+    cells = W.reshape(n * n, 2)
+
+    # Only cells next to a parent with enough fitness can see a birth. Parents only lose
+    # fitness here, so unless newborns are fit enough to spawn too, the rest can be skipped.
+    parents = index.of(kind)
+    parents = parents[cells[parents, 1] > birth_threshold]
+    if len(parents) == 0:
+        return
+    if atbirth_fitness > birth_threshold:
+        spaces = np.sort(np.concatenate((index.of(EMPTY), index.of(PLANT))))
+    else:
+        spaces = np.unique(neighbor_cells(np.divmod(parents, n), n))
+        spaces = spaces[cells[spaces, 0] <= 1]
+    if len(spaces) == 0:
+        return
+    turn = rng.permutation(len(spaces))
+
+    near = neighbor_cells(np.divmod(spaces, n), n)
+    window = window_cells(spaces, n)
+    window_slots, window_found = lookup(spaces, window)
+    window_found &= window != spaces[:, None]   # small worlds wrap onto themselves
+
+    waiting = np.ones(len(spaces), dtype = bool)
+    while waiting.any():
+        # This batch: the waiting cells that no waiting cell nearby comes before.
+        w = np.flatnonzero(waiting)
+        blocked_by = np.where(window_found[w] & waiting[window_slots[w]], turn[window_slots[w]], len(spaces))
+        batch = w[turn[w] < blocked_by.min(axis = 1)]
+        waiting[batch] = False
+
+        # Each looks at its first neighbor of the parent kind; does it have enough fitness to spawn?
+        is_parent = KIND_OF_TYPE[cells[near[batch], 0]] == kind
+        first = near[batch, is_parent.argmax(axis = 1)]
+        born = is_parent.any(axis = 1) & (cells[first, 1] > birth_threshold)
+        newborns, born_to = spaces[batch[born]], first[born]
+
+        # Birth, inheriting the parent's strategy.
+        for newborn, old_type, new_type in zip(newborns.tolist(), cells[newborns, 0].tolist(), cells[born_to, 0].tolist()):
+            index.retype(newborn, old_type, new_type)
+        cells[newborns, 0] = cells[born_to, 0]
+        cells[newborns, 1] = atbirth_fitness
+        # Birth takes some energy.
+        cells[born_to, 1] -= atbirth_fitness
+
+
+def starve_and_age(W, index):
+    ''' Deaths: critters burn some fitness, or starve if they have none left, and empty spaces age. '''
+    n = W.shape[0]
+
+    # Cells are looked at through the index, so only critters and empty spaces are touched.
+    cells = W.reshape(n * n, 2)
+
+    # An empty space.
+    # If it stays empty long enough and is adjacent to a plant, a plant will grow there.
+    cells[index.of(EMPTY), 1] += 1
+
+    # Decrement fitnesses, and remove any poor critters who have starved.
+    critters = np.concatenate((index.of(PREY), index.of(PRED)))
+    starved = critters[cells[critters, 1] == 0]
+    critters = critters[cells[critters, 1] > 0]
+    cells[critters, 1] -= 1   # it costs energy to stay alive
+    for this_critter in starved.tolist():
+        # Something has starved.
+        set_cell(divmod(this_critter, n), 0, 0, W, index)
+
+
+# The ways to run the birth phases: one cell at a time (the reference), or in batches.
+ENGINES = {
+    'reference': (grow_plants_reference, spawn_reference),
+    'numpy': (grow_plants, spawn),
+}
+
+
+
+def move_critters(W, index, prob_true_percept, pred_feeding_fitness, prey_feeding_fitness, rng, profile=None):
+    ''' Movement, random-sequential: predators and prey take turns, one critter at a time in random order.
+        Each turn is timed, if there is a profile (see PhaseProfile). '''
+    n = W.shape[0]
+
+    # Queue up all the predators and prey, in random order.
+    pred_cells = index.of(PRED).copy()
+    prey_cells = index.of(PREY).copy()
+    rng.shuffle(pred_cells)
+    rng.shuffle(prey_cells)
+    preds = CritterQueue(pred_cells, index.pending)
+    prey = CritterQueue(prey_cells, index.pending)
+
+    # We need as many episodes as we have critters.
     while (len(preds) > 0) or (len(prey) > 0):
-        
+
         # If any predators are left, fetch one.
         if len(preds) > 0:
-          
+
             # Pick a random predator.
-            this_pred_coords = preds.pop()
+            this_pred_coords = divmod(preds.pop(), n)
             this_pred_type = W[this_pred_coords[0], this_pred_coords[1], 0]
-            
+
             # Veridical perception
-            if this_pred_type == 7:   
+            if this_pred_type == 7:
                 # If any prey around, pick one at random and eat it.
-                W, prey = find_prey(this_pred_coords, prey, pred_feeding_fitness, W)
-                
+                W, prey = find_prey(this_pred_coords, prey, pred_feeding_fitness, W, index, rng)
+
             # No perception
             elif this_pred_type == 5:
                 # Try to make a random move. If a preditor is there, stay put.
-                W, prey = blind_cat_move(this_pred_coords, 
-                                         prey, 
-                                         pred_feeding_fitness, 
-                                         W)
-        
+                W, prey = blind_cat_move(this_pred_coords,
+                                         prey,
+                                         pred_feeding_fitness,
+                                         W, index, rng)
+
             # Correct perception with probability prob_true_percept.
             else:
-                if rand() < prob_true_percept:
+                if rng.random() < prob_true_percept:
                     # If any prey around, pick one at random and eat it.
-                    W, prey = find_prey(this_pred_coords, prey, pred_feeding_fitness, W)  
+                    W, prey = find_prey(this_pred_coords, prey, pred_feeding_fitness, W, index, rng)
                 else:
                     # Try to make a random move. If a preditor is there, stay put.
-                    W, prey = blind_cat_move(this_pred_coords, 
-                                             prey, 
-                                             pred_feeding_fitness,  
-                                             W)                    
-            
+                    W, prey = blind_cat_move(this_pred_coords,
+                                             prey,
+                                             pred_feeding_fitness,
+                                             W, index, rng)
+            if profile is not None:
+                profile.lap('pred_moves', 1)
+
         # If any prey are left, fetch one.
         if len(prey) > 0:
-            
+
             # Pick a random prey.
-            this_prey_coords = prey.pop()
+            this_prey_coords = divmod(prey.pop(), n)
             this_prey_type = W[this_prey_coords[0], this_prey_coords[1], 0]
-            
+
             # Veridical perception
-            if this_prey_type == 4:   
-                W, preds = find_pred(this_prey_coords, preds, prey_feeding_fitness, W)
-            
+            if this_prey_type == 4:
+                W, preds = find_pred(this_prey_coords, preds, prey_feeding_fitness, W, index, rng)
+
             # No perception
             elif this_prey_type == 2:
                 # Try to make a random move. If a prey is there, stay put.
-                W, preds, prey = blind_bird_move(this_pred_coords, 
-                                                 preds, 
-                                                 prey, 
+                W, preds, prey = blind_bird_move(this_prey_coords,
+                                                 preds,
+                                                 prey,
                                                  pred_feeding_fitness,
                                                  prey_feeding_fitness,
-                                                 W)
-                
+                                                 W, index, rng)
+
             # Correct perception with probability prob_true_percept.
             else:
-                if rand() < prob_true_percept:
+                if rng.random() < prob_true_percept:
                     # If any prey around, pick one at random and eat it.
-                    W, preds = find_pred(this_prey_coords, preds, prey_feeding_fitness, W)  
+                    W, preds = find_pred(this_prey_coords, preds, prey_feeding_fitness, W, index, rng)
                 else:
                     # Try to make a random move. If a preditor is there, stay put.
-                    W, preds, prey = blind_bird_move(this_pred_coords,
+                    W, preds, prey = blind_bird_move(this_prey_coords,
                                                     preds,
                                                     prey,
                                                     pred_feeding_fitness,
                                                     prey_feeding_fitness,
-                                                    W)
-                
+                                                    W, index, rng)
+            if profile is not None:
+                profile.lap('prey_moves', 1)
+
+
+def sublattice_colors(n):
+    ''' The color of each row (column) of an nxn torus: 0, 1, 2 over and over, and colors of
+        their own for the rows at the seam when n isn't a multiple of 3. '''
+    period = n - n % 3
+    color = np.arange(n) % 3
+    color[period:] = 3 + np.arange(n - period)
+    return color
+
+
+# Sublattices, computed once per world size.
+_sublattices = {}
+
+def sublattices(n, top=0, bottom=None):
+    ''' Splits an nxn torus into sublattices whose cells are all at least 3 apart, so that
+        critters on the same sublattice can't see or reach the same cells. That's a 3x3
+        coloring, with a row (column) or two of extra colors at the seam when n isn't a multiple of 3.
+        Returns a list of arrays of flat positions, one per sublattice.
+        With top and bottom, only those in rows top up to bottom, for a strip of the world (see
+        ca_domain); the list is as long for any strip, with sublattices it misses left empty. '''
+    if (n, top, bottom) not in _sublattices:
+        color = sublattice_colors(n)
+        colors = color[top:bottom, None] * 5 + color[None, :]
+        used = np.unique(color)
+        _sublattices[n, top, bottom] = [np.flatnonzero(colors == c) + top * n
+                                        for c in np.add.outer(used * 5, used).ravel()]
+    return _sublattices[n, top, bottom]
+
+
+def by_sublattice(cells, n):
+    ''' Splits an array of flat positions by sublattice: a list of arrays, one per sublattice in
+        the order sublattices(n) gives them, each in order of position. '''
+    color = np.unique(sublattice_colors(n), return_inverse = True)[1]
+    colors = color.max() + 1
+    i, j = np.divmod(cells, n)
+    # Sorted by sublattice, then position.
+    key = np.sort((color[i] * colors + color[j]).astype(np.int64) * (n * n) + cells)
+    lattice, cells = np.divmod(key, n * n)
+    return np.split(cells, np.searchsorted(lattice, np.arange(1, colors * colors)))
+
+
+def pick_at_random(near, allowed, rng):
+    ''' For each row of near, one of the positions that allowed marks, at random.
+        Returns (picked, found); picked is meaningless where found is False. '''
+    keys = rng.random(allowed.shape)
+    keys[~allowed] = -1
+    picked = near[np.arange(len(near)), keys.argmax(axis = 1)]
+    return picked, allowed.any(axis = 1)
+
+
+# Below this share of cells being critters, move_critters_sublattice goes by the critters rather
+# than by the whole world.
+SPARSE_OCCUPANCY = 0.1
+
+
+def move_critters_sublattice(W, index, prob_true_percept, pred_feeding_fitness, prey_feeding_fitness, rng,
+                             profile=None):
+    ''' Movement, sublattice by sublattice in random order: all the critters on one
+        sublattice move, eat and flee at the same time, with a fixed number of array operations.
+        The rules are those of move_critters; critters only differ in who goes first.
+        Each sublattice's moves are timed, if there is a profile (see PhaseProfile).
+
+        A world mostly full of critters is gone through cell by cell, and indexed again from
+        scratch. In a sparse one (see SPARSE_OCCUPANCY), the critters are found through the index,
+        which is then told only of the cells that changed, so a step costs as much as its critters,
+        not its cells. Both ways make the same moves; the index keeps its cells in another order,
+        which only matters to the reference births, which shuffle it. '''
+    n = W.shape[0]
+
+    # Every critter gets one move; one that is carried onto a later sublattice has already moved.
+    pending = index.pending
+    critters = np.concatenate((index.of(PRED), index.of(PREY)))
+    pending[critters] = True
+
+    sparse = len(critters) < SPARSE_OCCUPANCY * n * n
+    lattices = by_sublattice(critters, n) if sparse else sublattices(n)
+    changed = []
+    for s in rng.permutation(len(lattices)):
+        changed.append(move_sublattice(W, lattices[s], pending, prob_true_percept, pred_feeding_fitness,
+                                       prey_feeding_fitness, rng, profile))
+
+    if sparse:
+        changed = np.sort(np.concatenate(changed))
+        changed = changed[np.diff(changed, prepend = -1) != 0]
+        index.update(W, changed)
+        reindexed = len(changed)
+    else:
+        # Most cells may have changed, so the index is redone in bulk.
+        index.rebuild(W)
+        reindexed = n * n
+    if profile is not None:
+        profile.lap('reindex', reindexed)
+
+
+def move_sublattice(W, lattice, pending, prob_true_percept, pred_feeding_fitness, prey_feeding_fitness, rng,
+                    profile=None):
+    ''' The moves of the critters at the flat positions in lattice (all on one sublattice, see
+        sublattices) that pending marks as yet to move, all at once. Returns the cells it changed,
+        which may repeat. '''
+    n = W.shape[0]
+    cells = W.reshape(n * n, 2)
+    types, fitness = cells[:, 0], cells[:, 1]
+
+    here = lattice[pending[lattice]]
+    pending[here] = False
+    kinds = KIND_OF_TYPE[types[here]]
+
+    # Predators...
+    #
+    cats = here[kinds == PRED]
+    cat_types = types[cats]
+    near = neighbor_cells(np.divmod(cats, n), n)
+    near_kinds = KIND_OF_TYPE[types[near]]
+
+    # Veridical perception for 7, and for 6 with probability prob_true_percept.
+    # Those eat a random nearby prey, or else move to a random space or plant.
+    # The rest move to a random cell that isn't a cat, and eat any bird there.
+    sees = (cat_types == 7) | ((cat_types == 6) & (rng.random(len(cats)) < prob_true_percept))
+    prey_near = (near_kinds == PREY).any(axis = 1)
+    allowed = np.where(sees[:, None],
+                       np.where(prey_near[:, None], near_kinds == PREY, near_kinds <= PLANT),
+                       near_kinds != PRED)
+    to, found = pick_at_random(near, allowed, rng)
+    cats, to_cats = cats[found], to[found]
+    eats = KIND_OF_TYPE[types[to_cats]] == PREY
+    pending[to_cats] = False   # the poor things that got eaten
+
+    # Space, plant or prey replaced by this predator; a plant remains behind.
+    fitness[to_cats] = fitness[cats] + eats * pred_feeding_fitness
+    types[to_cats] = types[cats]
+    types[cats] = 1
+    fitness[cats] = 0
+    if profile is not None:
+        profile.lap('pred_moves', len(cat_types))
+
+    # Prey...
+    #
+    birds = here[kinds == PREY]
+    bird_types = types[birds]
+    near = neighbor_cells(np.divmod(birds, n), n)
+    near_kinds = KIND_OF_TYPE[types[near]]
+
+    # Veridical perception for 4, and for 3 with probability prob_true_percept.
+    # Those flee a random nearby predator if there is one, else eat a plant, else move to an empty space.
+    # The rest move to a random cell that isn't a bird: eating a plant, or getting eaten by a cat.
+    sees = (bird_types == 4) | ((bird_types == 3) & (rng.random(len(birds)) < prob_true_percept))
+    preds_near = (near_kinds == PRED).any(axis = 1)
+    plants_near = (near_kinds == PLANT).any(axis = 1)
+    chased_by, _ = pick_at_random(near, near_kinds == PRED, rng)
+    _, escapes = move_away_batch(birds, chased_by, W)
+    allowed = np.where(sees[:, None],
+                       np.where(preds_near[:, None], escapes,
+                                np.where(plants_near[:, None], near_kinds == PLANT, near_kinds == EMPTY)),
+                       near_kinds != PREY)
+    to, found = pick_at_random(near, allowed, rng)
+    birds, to = birds[found], to[found]
+    to_kinds = KIND_OF_TYPE[types[to]]
+
+    # OOPs, these birds picked a cell with a cat in it, and got eaten.
+    eaten = to_kinds == PRED
+    fitness[to[eaten]] += pred_feeding_fitness
+
+    # The rest replace a space or plant (which they eat).
+    moved = ~eaten
+    fitness[to[moved]] = fitness[birds[moved]] + (to_kinds[moved] == PLANT) * prey_feeding_fitness
+    types[to[moved]] = types[birds[moved]]
+    types[birds] = 0   # empty space, with its initial value
+    fitness[birds] = 0
+    if profile is not None:
+        profile.lap('prey_moves', len(bird_types))
+    return np.concatenate((cats, to_cats, birds, to))
+
+
+# The ways critters can take their moves.
+MODES = {
+    'sequential': move_critters,
+    'sublattice': move_critters_sublattice,
+}
+
+
+# Function to compute next generation.
+# Constants:  2 2 3 10 6 2 3 leads to extinction
+# Parameters defining the biologic parameters defining the ceatures' properties.
+RULES = {
+    'prey_atbirth_fitness': 3,
+    'pred_atbirth_fitness': 5,
+    'prey_birth_threshold': 9,
+    'pred_birth_threshold': 13,
+    'prey_feeding_fitness': 2,
+    'pred_feeding_fitness': 4,
+    'space_fallow_time': 3,     # number of iterations before empty space can grow a new plant
+    'prob_true_percept': 0.9,   # probability of veridical perception
+}
+
+
+def rules_with(changes=None):
+    ''' The rule constants, RULES, with some of them changed. '''
+    rules = dict(RULES)
+    for name, value in (changes or {}).items():
+        if name not in RULES:
+            raise ValueError('no rule constant called %r' % name)
+        rules[name] = value
+    return rules
+
+
+class PhaseProfile:
+    ''' How long each phase of time_step took (see ca_frames.PHASES), and how many cells it
+        handled: critters moved, cells looked at for births or deaths. Each phase's time runs
+        from the end of the one before, so together they make up the whole step.
+        Pass one to time_step to have a step timed; without one, nothing is timed at all. '''
+
+    def __init__(self):
+        self.seconds = dict.fromkeys(PHASES, 0.0)
+        self.counts = dict.fromkeys(PHASES, 0)
+        self.total_seconds = dict.fromkeys(PHASES, 0.0)
+        self.total_counts = dict.fromkeys(PHASES, 0)
+        self.generations = 0
+        self.last = 0.0
+
+    def start(self):
+        ''' A new step begins. '''
+        for phase in PHASES:
+            self.seconds[phase] = 0.0
+            self.counts[phase] = 0
+        self.last = perf_counter()
+
+    def lap(self, phase, count):
+        ''' The phase has just handled count more cells. '''
+        now = perf_counter()
+        self.seconds[phase] += now - self.last
+        self.counts[phase] += count
+        self.last = now
+
+    def finish(self):
+        ''' The step is done; adds it to the totals. '''
+        for phase in PHASES:
+            self.total_seconds[phase] += self.seconds[phase]
+            self.total_counts[phase] += self.counts[phase]
+        self.generations += 1
+
+    def message(self, generation):
+        ''' The last step, which made this generation, as a PROFILE message. '''
+        return encode_profile(generation, [self.seconds[phase] for phase in PHASES],
+                              [self.counts[phase] for phase in PHASES])
+
+    def summary(self):
+        ''' For each phase, over all steps timed so far: its seconds, the cells it handled, and
+            its mean milliseconds per step. '''
+        return {
+            phase: {
+                'seconds': self.total_seconds[phase],
+                'count': self.total_counts[phase],
+                'mean_ms': 1000 * self.total_seconds[phase] / max(self.generations, 1),
+            }
+            for phase in PHASES
+        }
+
+
+def time_step(W, index=None, engine='numpy', mode='sequential', rng=None, rules=None, profile=None):
+    ''' Update the state of the world by one time step.
+        index is the world's CellIndex; pass the same one every step to avoid rebuilding it.
+        engine picks how births are worked out, see ENGINES, and mode how critters move, see MODES.
+        rng is the run's RandomSource; pass the same one every step to reproduce a run.
+        rules are the rule constants, RULES unless given (see rules_with).
+        profile, a PhaseProfile, times each phase of the step if given.'''
+
+    if rules is None:
+        rules = RULES
+    prey_atbirth_fitness = rules['prey_atbirth_fitness']
+    pred_atbirth_fitness = rules['pred_atbirth_fitness']
+    prey_birth_threshold = rules['prey_birth_threshold']
+    pred_birth_threshold = rules['pred_birth_threshold']
+    prey_feeding_fitness = rules['prey_feeding_fitness']
+    pred_feeding_fitness = rules['pred_feeding_fitness']
+    space_fallow_time = rules['space_fallow_time']
+    prob_true_percept = rules['prob_true_percept']
+
+    if index is None:
+        index = CellIndex(W)
+    if rng is None:
+        rng = RandomSource()
+
+    if profile is not None:
+        profile.start()
+
+    # Every critter gets a move.
+    MODES[mode](W, index, prob_true_percept, pred_feeding_fitness, prey_feeding_fitness, rng, profile)
+
     #
     # Births
     #
-    
+    grow_plants, spawn = ENGINES[engine]
+
     # Plants...
-    #
-    # Fetch lists of the coordinates of all the empty cells.
-    empty = fetch_empty_coords(W)
-    np.random.shuffle(empty)
-    
-    # We need as many episodes as we have empty cells. 
-    while len(empty) > 0:
-        # Pick a random empty space.
-        this_space = empty.pop()
-        nearby_plants = find_nearby_plants(this_space, W)
-        if (len(nearby_plants) > 0) and (W[this_space[0], this_space[1], 1] > space_fallow_time):
-            W[this_space[0], this_space[1], 0] = 1   # a new plant
-            W[this_space[0], this_space[1], 1] = 0
-    
+    empty = index.counts[EMPTY]
+    grow_plants(W, index, space_fallow_time, rng)
+    if profile is not None:
+        profile.lap('plants', empty)
+
     # Prey...
-    #
-    # Fetch lists of the coordinates of all the empty cells.
-    empty = fetch_empty_or_plant_coords(W)  # includes empty cells or plant cells
-    np.random.shuffle(empty)
-     
-    # We need as many episodes as we have empty cells. 
-    while len(empty) > 0:
-        # Pick a random empty space.
-        this_space = empty.pop()
-        nearby_prey = find_nearby_prey(this_space, W)
-        
-        # Do any of the nearby_prey have enough fitness to spawn?
-        for bird in nearby_prey:
-            I, J = bird
-            if W[I, J, 1] > prey_birth_threshold: 
-                # Birth
-                W[this_space[0], this_space[1], 0] = W[I, J, 0]   # inherit parent bird's strategy
-                W[this_space[0], this_space[1], 1] = prey_atbirth_fitness
-                # Birth takes some energy.
-                W[I, J, 1] -= prey_atbirth_fitness
-            break
-            
-    # Predators... 
-    #
-    # Fetch lists of the coordinates of all the empty cells.
-    empty = fetch_empty_or_plant_coords(W)  # includes empty cells or plant cells
-    np.random.shuffle(empty)
-     
-    # We need as many episodes as we have empty cells. 
-    while len(empty) > 0:
-        # Pick a random empty space.
-        this_space = empty.pop()
-        nearby_pred = find_nearby_preds(this_space, W)
-        
-        # Do any of the nearby_pred have enough fitness to spawn?
-        for cat in nearby_pred:
-            I, J = cat
-            if W[I, J, 1] > pred_birth_threshold:   # a parameter
-                # Birth
-                W[this_space[0], this_space[1], 0] = W[I, J, 0]   # inherit parent cat's strategy 
-                W[this_space[0], this_space[1], 1] = pred_atbirth_fitness
-                # Birth takes some energy.
-                W[I, J, 1] -= pred_atbirth_fitness
-            break
-            
+    spaces = index.counts[EMPTY] + index.counts[PLANT]
+    spawn(W, index, PREY, prey_birth_threshold, prey_atbirth_fitness, rng)
+    if profile is not None:
+        profile.lap('prey_births', spaces)
+
+    # Predators...
+    spaces = index.counts[EMPTY] + index.counts[PLANT]
+    spawn(W, index, PRED, pred_birth_threshold, pred_atbirth_fitness, rng)
+    if profile is not None:
+        profile.lap('pred_births', spaces)
+
     #
     # Deaths
     #
-    
-    # Decrement fitnesses, and remove any poor critters who have starved.
-    for i in range(n):
-        for j in range(n):
-            
-            if W[i, j, 0] > 1:
-                # Then there's a critter on this space.
-                if W[i, j, 1] > 0:
-                    W[i, j, 1] -= 1   # it costs energy to stay alive
-                else:
-                    # Something has starved.
-                    W[i, j, 0] = 0 
-                    W[i, j, 1] = 0
-                    
-            elif W[i, j, 0] == 0:
-                # An empty space. 
-                # If it stays empty long enough and is adjacent to a plant, a plant will grow there.
-                W[i, j, 1] += 1
+    cells = index.counts[EMPTY] + index.counts[PREY] + index.counts[PRED]
+    starve_and_age(W, index)
+    if profile is not None:
+        profile.lap('deaths', cells)
+        profile.finish()
     return W
 
 
-def gen_ca(n, p, q, pipe):
+def population_stats(W):
+    ''' The number of cells of each type in world W, and their mean fitness (for empty cells,
+        how long they have lain fallow), as two lists. '''
+    types = W[:, :, 0].ravel()
+    counts = np.bincount(types, minlength = TYPES)
+    fitness = np.bincount(types, weights = W[:, :, 1].ravel(), minlength = TYPES)
+    return counts.tolist(), (fitness / np.maximum(counts, 1)).tolist()
+
+
+def read_messages(pipe, encoder, channels):
+    ''' Acts on the messages waiting in the pipe: None to stop, ('zoom', region) to change the
+        region frames show (see FrameEncoder.zoom), ('subscribe', {'frames': ..., 'stats': ...,
+        'profile': ...}) to change what is sent of each generation (see channels in gen_ca).
+        Returns False if told to stop. '''
+    while pipe.poll():
+        message = pipe.recv()
+        if message is None:
+            return False
+        if message[0] == 'zoom':
+            encoder.zoom(message[1])
+        elif message[0] == 'subscribe':
+            channels.update(message[1])
+    return True
+
+
+def send_generation(generation, W, encoder, pipe, ring, when_full, channels, stats=None, profile=None):
+    ''' Sends what is subscribed to of a generation: its population statistics up the pipe, if
+        channels['stats'] (ready-made stats can be given), the PROFILE message of the step that
+        made it, if it was timed, and its frame, if channels['frames'].
+        Returns False if told to stop. '''
+    if channels['stats']:
+        pipe.send_bytes(stats or encode_stats(generation, *population_stats(W)))
+    if profile is not None:
+        pipe.send_bytes(profile)
+    if channels['frames']:
+        return send_frame(generation, W, encoder, pipe, ring, when_full, channels)
+    return True
+
 
-    # Initialize the world.
-    W = init_world(n, p, q)
+def send_frame(generation, W, encoder, pipe, ring, when_full, channels):
+    ''' Sends the frame for this generation: into the ring if there is one, else up the pipe.
+        If the ring is full, waits for room or skips the frame, as when_full says ('wait' or 'skip').
+        Frames written to the ring are announced with a READY message up the pipe.
+        Returns False if told to stop while waiting. '''
+    if ring is None:
+        pipe.send_bytes( encoder.encode(generation, W) )
+        return True
 
-    pipe.send( W[:, :, 0].tolist() )
+    while not ring.has_room():
+        if when_full == 'skip':
+            # Never encoded, so the next delta is still against the last frame sent.
+            ring.skip()
+            return True
+        if pipe.poll(0.005) and not read_messages(pipe, encoder, channels):
+            return False
+    ring.write( encoder.encode(generation, W) )
+    pipe.send_bytes(READY)
+    return True
+
+
+def cache_generation(cached, generation, W, stats, index, rng):
+    ''' Adds a generation to a CachedRun, and returns it, or None once it can take no more: the
+        run is then kept up to this generation, and carries on without the cache. '''
+    cached.append(generation, W, stats)
+    if cached.room(W, rng):
+        return cached
+    cached.save(generation, W, index, rng)
+    cached.close()
+    return None
+
+
+def gen_ca(n, p, q, pipe, seed=None, engine='numpy', mode='sequential', keyframe_interval=50, compress=True,
+           ring=None, ring_slots=8, when_full='wait', viewport=None, cache=None, cache_bytes=1 << 30, rules=None,
+           frames=True, stats=False, profile=False, workers=None):
+    ''' Runs a world until told to stop (None down the pipe), sending each generation as a binary
+        frame (see ca_frames.FrameEncoder), no more than viewport cells across if given. Frames go
+        into the shared-memory FrameRing named ring, with ring_slots slots, if there is one, else
+        up the pipe. With stats, the population statistics of each generation go up the pipe too
+        (see ca_frames.encode_stats); without frames, only they do. With profile, each step is
+        timed phase by phase and that goes up the pipe too (see PhaseProfile). At the end it sends
+        an empty message up the pipe, followed by a summary of the run, with totals of the timings.
+
+        A seeded run is the same every time. With a cache folder, seeded runs are kept in a
+        ResultCache of at most cache_bytes: the generations cached already are sent from there,
+        and only the ones after them simulated. rules changes some of the rule constants (see rules_with).
+
+        With workers, the world is split among that many processes, each stepping a strip of it
+        (see ca_domain.DomainWorld); engine and mode make no difference then. Such runs are not
+        cached or profiled. '''
+
+    # All of this run's random numbers come from here.
+    rng = RandomSource(seed)
+    rules = rules_with(rules)
+    if ring is not None:
+        ring = FrameRing.attach(ring, ring_slots, max_frame_size(n))
+    encoder = FrameEncoder(keyframe_interval, compress, viewport)
+    # What is sent of each generation; the client can change this as the run goes.
+    channels = {
+        'frames': frames,
+        'stats': stats,
+        'profile': profile,
+    }
+    profiler = PhaseProfile()
+
+    # Everything that decides how the run goes.
+    cached = None
+    domain = None
+    if cache is not None and seed is not None and not workers:
+        cached = ResultCache(cache, cache_bytes).open({
+            'model': 'eco',
+            'engine': engine,
+            'mode': mode,
+            'n': n,
+            'p': p,
+            'q': q,
+            'rules': rules,
+            'seed': seed,
+        })
+    checkpoint = cached.checkpoint() if cached else None
+
+    running = True
+    W = None
+    if checkpoint:
+        # Send what is cached, then carry on from where it got to.
+        for generation, types, cached_stats in cached.replay():
+            running = read_messages(pipe, encoder, channels) and send_generation(
+                generation, types[:, :, None], encoder, pipe, ring, when_full, channels, cached_stats)
+            if not running:
+                break
+        replayed = generation + 1
+        if running:
+            generation, W, order, state = checkpoint
+            index = CellIndex(W, order)
+            rng.setstate(state)
+            if not cached.room(W, rng):
+                # Cached as far as it can be already.
+                cached.close()
+                cached = None
+    else:
+        # Initialize the world.
+        replayed = 0
+        W = init_world(n, p, q, rng.generator)
+        if workers:
+            # Stepped in shared memory, from which frames are encoded as they are.
+            domain = ca_domain.DomainWorld(W, workers, rules, seed)
+            W = domain.W
+        else:
+            index = CellIndex(W)
+        generation = 0
+        stats = encode_stats(generation, *population_stats(W)) if cached or channels['stats'] else None
+        if cached:
+            cached = cache_generation(cached, generation, W, stats, index, rng)
+        running = send_generation(generation, W, encoder, pipe, ring, when_full, channels, stats)
 
     # Iteration loop.
-    while True:
-        if pipe.poll() and pipe.recv() == None:
+    while running:
+        if not read_messages(pipe, encoder, channels):
             break
 
-        W = time_step(W)
+        profiled = channels['profile'] and domain is None
+        if domain:
+            domain.step()
+        else:
+            W = time_step(W, index, engine, mode, rng, rules, profiler if profiled else None)
+        generation += 1
+        stats = encode_stats(generation, *population_stats(W)) if cached or channels['stats'] else None
+        if cached:
+            cached = cache_generation(cached, generation, W, stats, index, rng)
 
-        pipe.send( W[:, :, 0].tolist() )
-    
-    pipe.send(None)
\ No newline at end of file
+        running = send_generation(generation, W, encoder, pipe, ring, when_full, channels, stats,
+                                  profiler.message(generation) if profiled else None)
+
+    if cached:
+        # Unless it was stopped before getting past what was cached already.
+        if W is not None:
+            cached.save(generation, W, index, rng)
+        cached.close()
+    if domain:
+        domain.close()
+
+    pipe.send_bytes(b'')
+    pipe.send({
+        'generations': generation + 1,
+        'cached_generations': replayed,
+        'skipped_frames': ring.skipped() if ring is not None else 0,
+        'compression_ratio': encoder.compression_ratio(),
+        'profiled_generations': profiler.generations,
+        'profile': profiler.summary() if profiler.generations else None,
+    })
+    if ring is not None:
+        ring.close()
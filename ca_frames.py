@@ -0,0 +1,182 @@
+import struct
+import zlib
+import numpy as np
+
+# Every frame starts with this header (little-endian): generation number, size of the frame's
+# square grid, encoding (padded to 4 bytes), and the square of the world the frame shows: its top
+# row, left column and size in cells. The payload that follows depends on the encoding.
+# A frame of the whole world at full resolution has a grid the size of the world; a smaller grid
+# holds the most common type of each block of cells (see dominant_types).
+HEADER = struct.Struct('<IIB3xIII')
+
+# Cell types: 0 empty, 1 plant, 2-4 birds, 5-7 cats.
+TYPES = 8
+
+# Population statistics of one generation, sent apart from its frame: a tag, the generation
+# number, the number of cells of each type, and their mean fitness (little-endian).
+STATS = struct.Struct('<cI%dI%df' % (TYPES, TYPES))
+STATS_TAG = b'S'
+
+# Phases of a step of ca_eco (see ca_eco.PhaseProfile), and the wall time each took in one
+# generation (seconds) and the number of cells it handled, sent apart from its frame: a tag, the
+# generation number, the times, then the counts (little-endian).
+PHASES = ('pred_moves', 'prey_moves', 'reindex', 'plants', 'prey_births', 'pred_births', 'deaths')
+PROFILE = struct.Struct('<cI%dd%dI' % (len(PHASES), len(PHASES)))
+PROFILE_TAG = b'P'
+
+# Encodings.
+RAW = 0        # all n x n cell types, one byte per cell, row by row
+RAW_ZLIB = 1   # the same, compressed with zlib
+DELTA = 2      # only the cells that changed since the last frame: their flat positions (uint32), then their types
+XOR_ZLIB = 3   # the XOR of all cell types with the last frame's, compressed with zlib
+
+# Encodings that stand on their own; the others only make sense after the frame before them.
+KEYFRAMES = {RAW, RAW_ZLIB}
+
+
+def max_frame_size(n):
+    ''' The most bytes a frame of an nxn world can take; a FrameEncoder never beats a raw frame by losing. '''
+    return HEADER.size + n * n
+
+
+def dominant_types(types, block):
+    ''' The most common cell type in each block x block square of types (the lowest one on a tie),
+        as a smaller grid. Blocks along the bottom and right edges may be cut short. '''
+    h, w = types.shape
+    rows, cols = -(-h // block), -(-w // block)
+
+    # Count the cells of each type in each block at once, with every cell's block and type as one key.
+    block_of_row = (np.arange(h, dtype = np.int32) // block) * cols
+    block_of_col = np.arange(w, dtype = np.int32) // block
+    keys = (block_of_row[:, None] + block_of_col) * TYPES + types
+    counts = np.bincount(keys.ravel(), minlength = rows * cols * TYPES)
+    return counts.reshape(rows, cols, TYPES).argmax(axis = 2).astype(np.uint8)
+
+
+def view(n, viewport=None, region=None):
+    ''' What a frame of an nxn world shows: (top, left, size, block). That is the square region
+        (top, left, size) of the world, or all of it, with each block x block square of cells
+        shown as one, so the frame is no more than viewport cells across. '''
+    top, left, size = region if region else (0, 0, n)
+    size = min(max(int(size), 1), n)
+    top = min(max(int(top), 0), n - size)
+    left = min(max(int(left), 0), n - size)
+    block = -(-size // viewport) if viewport else 1
+    return top, left, size, block
+
+
+def encode_frame(generation, W):
+    ''' The cell types of world W as a raw frame, ready to be sent as a binary WebSocket message. '''
+    n = W.shape[0]
+    return HEADER.pack(generation, n, RAW, 0, 0, n) + W[:, :, 0].tobytes()
+
+
+def decode_frame(frame, previous=None):
+    ''' Returns (generation, n, types) for a frame made by encode_frame or a FrameEncoder,
+        n being the size of the frame's grid. Deltas need the types of the frame before, as previous. '''
+    generation, n, encoding, _, _, _ = HEADER.unpack_from(frame)
+    payload = memoryview(frame)[HEADER.size:]
+    if encoding in (RAW_ZLIB, XOR_ZLIB):
+        payload = zlib.decompress(payload)
+    if encoding in KEYFRAMES:
+        return generation, n, np.frombuffer(payload, dtype = np.uint8).reshape(n, n)
+
+    types = previous.copy()
+    if encoding == DELTA:
+        count = len(payload) // 5
+        changed = np.frombuffer(payload, dtype = '<u4', count = count)
+        types.ravel()[changed] = np.frombuffer(payload, dtype = np.uint8, offset = 4 * count)
+    else:
+        types ^= np.frombuffer(payload, dtype = np.uint8).reshape(n, n)
+    return generation, n, types
+
+
+def encode_stats(generation, counts, fitness):
+    ''' The population statistics of a generation as a STATS message. '''
+    return STATS.pack(STATS_TAG, generation, *counts, *fitness)
+
+
+def decode_stats(message):
+    ''' Returns (generation, counts, fitness) for a message made by encode_stats. '''
+    fields = STATS.unpack(message)
+    return fields[1], list(fields[2:2 + TYPES]), list(fields[2 + TYPES:])
+
+
+def encode_profile(generation, seconds, counts):
+    ''' The time taken by each phase of a generation, and the cells it handled, as a PROFILE message. '''
+    return PROFILE.pack(PROFILE_TAG, generation, *seconds, *counts)
+
+
+def decode_profile(message):
+    ''' Returns (generation, seconds, counts) for a message made by encode_profile. '''
+    fields = PROFILE.unpack(message)
+    return fields[1], list(fields[2:2 + len(PHASES)]), list(fields[2 + len(PHASES):])
+
+
+def as_keyframe(frame, types):
+    ''' The frame, whose cell types (as decoded) are types, made to stand on its own. '''
+    generation, n, encoding, top, left, size = HEADER.unpack_from(frame)
+    if encoding in KEYFRAMES:
+        return bytes(frame)
+    return HEADER.pack(generation, n, RAW_ZLIB, top, left, size) + zlib.compress(types.tobytes(), 1)
+
+
+class FrameEncoder:
+    ''' Encodes the frames of one run. A keyframe goes out every keyframe_interval generations;
+        in between only what changed since the last frame is sent, as a delta or (with compress)
+        a compressed XOR, unless a full frame would be smaller. Keeps count of the bytes saved.
+
+        With a viewport (in pixels), frames are no more cells across than that, however big the
+        world; zoom() picks the region of the world they show. '''
+
+    def __init__(self, keyframe_interval=50, compress=True, viewport=None):
+        self.keyframe_interval = keyframe_interval
+        self.compress = compress
+        self.viewport = viewport
+        self.region = None
+        self.previous = None
+        self.since_keyframe = 0
+
+        # Bytes that raw frames would have taken, and bytes actually sent.
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+
+    def zoom(self, region=None):
+        ''' Show only the square region (top, left, size) of the world from the next frame on,
+            or the whole world again if region is None. '''
+        self.region = region
+        # The next frame shows something else, so it can not be a delta.
+        self.previous = None
+
+    def encode(self, generation, W):
+        ''' The cell types of world W as a frame, ready to be sent as a binary WebSocket message. '''
+        top, left, size, block = view(W.shape[0], self.viewport, self.region)
+        types = W[top:top + size, left:left + size, 0]
+        if block > 1:
+            types = dominant_types(types, block)
+        types = np.ascontiguousarray(types)
+        n = types.shape[0]
+        raw = types.tobytes()
+
+        # Every way of sending this frame, the smallest of which gets picked.
+        choices = [(RAW, raw)]
+        if self.compress:
+            choices.append((RAW_ZLIB, zlib.compress(raw, 1)))
+        if self.previous is not None and self.previous.shape == types.shape and self.since_keyframe < self.keyframe_interval:
+            changed = np.flatnonzero(types != self.previous)
+            choices.append((DELTA, changed.astype('<u4').tobytes() + types.ravel()[changed].tobytes()))
+            if self.compress:
+                choices.append((XOR_ZLIB, zlib.compress((types ^ self.previous).tobytes(), 1)))
+        encoding, payload = min(choices, key = lambda choice: len(choice[1]))
+
+        self.since_keyframe = 1 if encoding in KEYFRAMES else self.since_keyframe + 1
+        self.previous = types.copy()
+        frame = HEADER.pack(generation, n, encoding, top, left, size) + payload
+        # Counted against a full-resolution frame of the whole world.
+        self.raw_bytes += HEADER.size + W.shape[0] * W.shape[1]
+        self.sent_bytes += len(frame)
+        return frame
+
+    def compression_ratio(self):
+        ''' How many times smaller the frames sent so far were than raw frames. '''
+        return self.raw_bytes / self.sent_bytes if self.sent_bytes else 1.0
@@ -0,0 +1,183 @@
+import json
+import mmap
+import os
+import numpy as np
+from ca_frames import HEADER, KEYFRAMES, as_keyframe, decode_frame
+
+# One entry of a run's index per frame: its generation, and where it is in the frames file.
+INDEX = np.dtype([
+    ('generation', '<u4'),
+    ('length', '<u4'),
+    ('offset', '<u8'),
+])
+
+
+class RunHistory:
+    ''' The frames of one run on disk, in the directory folder under the run's id:
+            <run>.json    what the run was started with
+            <run>.frames  every frame, as sent, one after another (keyframes and deltas)
+            <run>.index   where each frame starts, in generation order (see INDEX)
+        Both files are only ever appended to, so they can be read, memory-mapped, while the run
+        is still going; any generation can be had by decoding from the keyframe before it. '''
+
+    def __init__(self, folder, run):
+        self.folder = folder
+        self.run = run
+        self.writing = False
+        self._frames = self._index = None
+
+    def path(self, ext):
+        return os.path.join(self.folder, self.run + ext)
+
+    @classmethod
+    def create(cls, folder, run, params, max_bytes=None):
+        ''' A history for a run started with params, ready to append frames to; new and empty,
+            unless there is one under this id already, in which case frames go after its own.
+            With max_bytes, the run stops being recorded once its frames and index would take
+            more than that: the frames before are kept, none after. '''
+        os.makedirs(folder, exist_ok = True)
+        history = cls(folder, run)
+        with open(history.path('.json'), 'w') as f:
+            json.dump(params, f)
+        # Unbuffered, so each frame is on its way to disk (and readable) as soon as it is appended.
+        history.frames_file = open(history.path('.frames'), 'ab', buffering = 0)
+        history.index_file = open(history.path('.index'), 'ab', buffering = 0)
+        history.size = history.frames_file.tell()
+        history.index_size = history.index_file.tell()
+        history.max_bytes = max_bytes
+        history.full = False
+        history.writing = True
+        return history
+
+    @classmethod
+    def open(cls, folder, run):
+        ''' The history of a run recorded earlier, or None if there is none. '''
+        history = cls(folder, run)
+        if not (run.isalnum() and os.path.exists(history.path('.index'))):
+            return None
+        return history
+
+    def params(self):
+        with open(self.path('.json')) as f:
+            return json.load(f)
+
+    def append(self, frame):
+        ''' Adds the next frame of the run. '''
+        self.extend([frame])
+
+    def extend(self, frames):
+        ''' Adds the next frames of the run, with one write to the index for all of them, and
+            the frames written before it, so a reader never finds a frame that is not there yet. '''
+        index = np.zeros(len(frames), dtype = INDEX)
+        count = 0
+        for frame in frames:
+            # Past max_bytes, this frame and every one after it go unrecorded; a delta is no use
+            # without the frames before it.
+            if self.max_bytes is not None and self.size + len(frame) + self.index_size + INDEX.itemsize > self.max_bytes:
+                self.full = True
+            if self.full:
+                break
+            index[count] = (HEADER.unpack_from(frame)[0], len(frame), self.size)
+            self.frames_file.write(frame)
+            self.size += len(frame)
+            self.index_size += INDEX.itemsize
+            count += 1
+        if count:
+            self.index_file.write(index[:count].tobytes())
+
+    def truncate(self, count):
+        ''' Keeps only the first count frames, throwing the rest away. '''
+        index = self.index()[:count]
+        self.size = int(index['offset'][-1] + index['length'][-1]) if count else 0
+        self._frames = self._index = None
+        self.index_size = count * INDEX.itemsize
+        self.full = False
+        self.frames_file.truncate(self.size)
+        self.index_file.truncate(self.index_size)
+
+    def nbytes(self):
+        ''' How much disk the run takes. '''
+        return sum(os.path.getsize(self.path(ext)) for ext in ('.json', '.frames', '.index'))
+
+    def touch(self):
+        ''' Marks the run as just used, so prune keeps it longest. '''
+        os.utime(self.path('.json'))
+
+    def close(self):
+        if self.writing:
+            self.writing = False
+            self.frames_file.close()
+            self.index_file.close()
+        # The maps close once nothing reads from them any more.
+        self._frames = self._index = None
+
+    def _map(self, view, ext):
+        # The file memory-mapped, mapped again if it has grown since. An old map is left to be
+        # closed once arrays still reading from it are gone.
+        size = os.path.getsize(self.path(ext))
+        if size and (view is None or len(view) < size):
+            with open(self.path(ext), 'rb') as f:
+                view = mmap.mmap(f.fileno(), size, access = mmap.ACCESS_READ)
+        return view
+
+    def index(self):
+        ''' The index of all frames so far, as a structured array (see INDEX). '''
+        self._index = self._map(self._index, '.index')
+        if self._index is None:
+            return np.zeros(0, dtype = INDEX)
+        return np.frombuffer(self._index, dtype = INDEX, count = len(self._index) // INDEX.itemsize)
+
+    def frame(self, entry):
+        ''' The frame of an index entry. '''
+        offset, length = int(entry['offset']), int(entry['length'])
+        if self._frames is None or len(self._frames) < offset + length:
+            self._frames = self._map(self._frames, '.frames')
+        return self._frames[offset:offset + length]
+
+    def frames(self, start, stop):
+        ''' The frames of generations start up to stop (not included) that were recorded, the first
+            of them made a keyframe, so they can be decoded without anything before them. '''
+        index = self.index()
+        first, last = np.searchsorted(index['generation'], [start, stop])
+        if first >= last:
+            return []
+
+        # Decode from the keyframe the first frame depends on up to it.
+        key = first
+        while HEADER.unpack_from(self.frame(index[key]))[2] not in KEYFRAMES:
+            key -= 1
+        types = None
+        for entry in index[key:first + 1]:
+            _, _, types = decode_frame(self.frame(entry), types)
+
+        frames = [as_keyframe(self.frame(index[first]), types)]
+        frames.extend(self.frame(entry) for entry in index[first + 1:last])
+        return frames
+
+
+def prune(folder, max_bytes, keep=()):
+    ''' Throws runs recorded in folder away, least recently used first (see RunHistory.touch),
+        until the rest take no more than max_bytes. Runs whose ids are in keep are left alone, and
+        not counted: runs still being recorded are kept to a size of their own (see RunHistory.create). '''
+    runs = []
+    for name in os.listdir(folder):
+        run, ext = os.path.splitext(name)
+        if ext == '.json' and run not in keep:
+            history = RunHistory(folder, run)
+            try:
+                runs.append((os.path.getmtime(history.path('.json')), run, history.nbytes()))
+            except FileNotFoundError:
+                # Thrown away just now, by another prune.
+                continue
+
+    total = sum(size for _, _, size in runs)
+    for _, run, size in sorted(runs):
+        if total <= max_bytes:
+            break
+        history = RunHistory(folder, run)
+        for ext in ('.json', '.frames', '.index'):
+            try:
+                os.remove(history.path(ext))
+            except FileNotFoundError:
+                pass
+        total -= size
@@ -0,0 +1,116 @@
+import bisect
+
+# Counters, gauges and histograms, served as text in the Prometheus exposition format:
+#
+#   # HELP ca_frames_sent_total Frames sent to clients.
+#   # TYPE ca_frames_sent_total counter
+#   ca_frames_sent_total 1234
+#
+# Each metric has a value per combination of its labels' values, given in order wherever the
+# metric is updated. Updating one is a dict lookup and an addition or two, cheap enough to do per
+# frame. Instead of being updated, a metric can be given a function that works out its values
+# each time they are asked for, as a dict of label values (a tuple) to value.
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=(), function=None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.function = function
+        self.values = {}
+
+    def remove(self, *values):
+        ''' Drops the value for these label values, for things that are gone (a run that ended). '''
+        self.values.pop(values, None)
+
+    def samples(self):
+        ''' (name, labels, value) for every value, labels as a dict. '''
+        values = self.function() if self.function else self.values
+        for key, value in values.items():
+            yield self.name, dict(zip(self.labels, key)), value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+        for name, labels, value in self.samples():
+            lines.append('%s%s %s' % (name, format_labels(labels), format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    ''' A count that only goes up. '''
+    kind = 'counter'
+
+    def inc(self, amount=1, *values):
+        self.values[values] = self.values.get(values, 0) + amount
+
+
+class Gauge(Metric):
+    ''' A value that goes up and down. '''
+    kind = 'gauge'
+
+    def set(self, value, *values):
+        self.values[values] = value
+
+    def inc(self, amount=1, *values):
+        self.values[values] = self.values.get(values, 0) + amount
+
+
+class Histogram(Metric):
+    ''' How many observations fell in each bucket, buckets being given by their upper bounds, and
+        their sum and count. '''
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets, labels=()):
+        super().__init__(name, help, labels)
+        self.buckets = sorted(buckets)
+
+    def observe(self, value, *values):
+        counts = self.values.get(values)
+        if counts is None:
+            # One count per bucket, one more for above them all, then the sum.
+            counts = self.values[values] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self):
+        for key, counts in self.values.items():
+            labels = dict(zip(self.labels, key))
+            total = 0
+            for bound, count in zip(self.buckets + [float('inf')], counts):
+                total += count
+                yield self.name + '_bucket', dict(labels, le = format_value(bound)), total
+            yield self.name + '_sum', labels, counts[-1]
+            yield self.name + '_count', labels, total
+
+
+class Registry:
+    ''' The metrics to serve, rendered in the order they were added. '''
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{%s}' % ','.join('%s="%s"' % (name, value) for name, value in zip(labels, escaped))
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
@@ -0,0 +1,158 @@
+import asyncio
+import multiprocessing
+import os
+import ca_eco
+
+# Told to a worker, in place of a job, to make it exit.
+EXIT = 'exit'
+
+
+def worker(pipe):
+    ''' The loop of one pool worker: takes a job (the keyword arguments of ca_eco.gen_ca) from
+        the pipe, runs it to the end, and waits for the next. The pipe then belongs to the run,
+        which is told to stop by a None. Stray messages for a run that has ended are ignored. '''
+    while True:
+        job = pipe.recv()
+        if job == EXIT:
+            return
+        if isinstance(job, dict):
+            ca_eco.gen_ca(pipe = pipe, **job)
+
+
+class Run:
+    ''' A run of the pool: in line for a worker until it gets its pipe, then running on that worker.
+        Stop a running run with stop(); one still in line is stopped by cancelling the task awaiting start(),
+        and taken out of line with WorkerPool.withdraw() if that task never got to start() at all. '''
+
+    def __init__(self):
+        # Counted in WorkerPool.waiting until it has its workers or is withdrawn.
+        self.waiting = True
+        self.pipe = None
+        # Workers kept idle for the run, for processes of its own to run in their place (see WorkerPool.start).
+        self.held = []
+        self.stopped = False
+
+    def started(self):
+        return self.pipe is not None
+
+    def send(self, message):
+        ''' Passes a message on to the running simulation (see ca_eco.read_messages). '''
+        if self.started() and not self.stopped:
+            self.pipe.send(message)
+
+    def stop(self):
+        # Only ever once per run: a second None could reach the worker's next run.
+        if self.started() and not self.stopped:
+            self.stopped = True
+            self.pipe.send(None)
+
+
+class WorkerPool:
+    ''' A fixed number of warm simulation processes, forked with numpy and ca_eco already
+        imported, each running one simulation at a time. Runs wait in line for a free worker,
+        up to max_waiting of them; beyond that submit() turns them away.
+        Workers are forked from a fork server of their own, started with the pool: make the pool
+        before opening any sockets, and no worker, not even one started later in place of one
+        that died, holds any of them. '''
+
+    def __init__(self, size=None, max_waiting=None):
+        self.size = size or os.cpu_count()
+        self.max_waiting = self.size if max_waiting is None else max_waiting
+        self.waiting = 0
+        self.idle = asyncio.Queue()
+        # Runs take their workers one at a time, so that two runs each after several of them
+        # can't each end up holding some and waiting on the other forever.
+        self.gathering = asyncio.Lock()
+        self.processes = []
+        self.pipes = []
+
+        self.context = multiprocessing.get_context('forkserver')
+        self.context.set_forkserver_preload(['ca_eco'])
+        for _ in range(self.size):
+            self._add(*self._spawn())
+
+    def _spawn(self):
+        conn1, conn2 = self.context.Pipe(True)
+        # Not a daemon, so a run can have processes of its own (see ca_domain); close() ends it.
+        process = self.context.Process(target = worker, args = (conn2,))
+        process.start()
+        conn2.close()
+        return conn1, process
+
+    def _add(self, pipe, process):
+        self.processes.append(process)
+        self.pipes.append(pipe)
+        self.idle.put_nowait(pipe)
+
+    def busy(self):
+        ''' How many workers are running a simulation, or held for one. '''
+        return self.size - self.idle.qsize()
+
+    def queued(self):
+        ''' How many runs are in line with no worker free for them. '''
+        return max(self.waiting - self.idle.qsize(), 0)
+
+    def full(self):
+        ''' Whether a new run would be turned away. '''
+        return self.queued() >= self.max_waiting
+
+    def submit(self):
+        ''' A new Run, in line for a worker, or None if the line is full. Start it with start(). '''
+        if self.full():
+            return None
+        self.waiting += 1
+        return Run()
+
+    async def start(self, run, slots=1, **job):
+        ''' Waits for a free worker and sets it running ca_eco.gen_ca with these arguments.
+            A run that starts slots processes of its own (see ca_domain) takes that many workers,
+            the rest being kept idle while it runs, so the pool never has more processes busy
+            than it has workers. Hand the workers back with release() once the end of the run
+            (see gen_ca) has been read. '''
+        pipes = []
+        try:
+            async with self.gathering:
+                while len(pipes) < min(slots, self.size):
+                    pipes.append(await self.idle.get())
+        except BaseException:
+            for pipe in pipes:
+                self.idle.put_nowait(pipe)
+            raise
+        finally:
+            self.withdraw(run)
+        run.pipe, run.held = pipes[0], pipes[1:]
+        run.pipe.send(job)
+
+    def withdraw(self, run):
+        ''' Takes a run out of line, if it is still in it; start() does once the run has its workers
+            (or gives up on them), and a run that never gets to start() must be withdrawn. '''
+        if run.waiting:
+            run.waiting = False
+            self.waiting -= 1
+
+    def release(self, run):
+        for pipe in [run.pipe] + run.held:
+            self.idle.put_nowait(pipe)
+
+    async def replace(self, run):
+        ''' The worker of this run died; puts a new one in its place. '''
+        i = self.pipes.index(run.pipe)
+        self.pipes.pop(i).close()
+        process = self.processes.pop(i)
+        for pipe in run.held:
+            self.idle.put_nowait(pipe)
+        # Off the event loop: the dead worker may take a moment to be reaped, and a new one to start.
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, process.join, 1)
+        self._add(*await loop.run_in_executor(None, self._spawn))
+
+    def close(self):
+        for pipe in self.pipes:
+            try:
+                pipe.send(EXIT)
+            except OSError:
+                pass
+        for process in self.processes:
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
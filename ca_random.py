@@ -0,0 +1,54 @@
+import numpy as np
+
+# Random numbers for one run of a simulation.
+class RandomSource:
+    ''' Hands out random numbers for one run, from its own numpy.random.Generator.
+        Single numbers are drawn a block at a time and handed out from a list, which is much
+        cheaper than a numpy call each; arrays come straight from the generator.
+        Seeding it reproduces a whole run, bit for bit, and runs never share state. '''
+
+    def __init__(self, seed=None, block_size=1 << 16):
+        self.generator = np.random.default_rng(seed)
+        self.block_size = block_size
+        self._next = iter(()).__next__
+
+    def getstate(self):
+        ''' Where this source is up to, to carry on from later with setstate.
+            A dict of the generator's state and the numbers left in the current block. '''
+        rest = list(self._next.__self__)
+        self._next = iter(rest).__next__
+        return {
+            'generator': self.generator.bit_generator.state,
+            'block': rest,
+        }
+
+    def setstate(self, state):
+        ''' Carry on from where getstate was, drawing the very same numbers from here on. '''
+        self.generator.bit_generator.state = state['generator']
+        self._next = iter(state['block']).__next__
+
+    def random(self, size=None):
+        ''' A float in [0, 1), or an array of them if size is given. '''
+        if size is not None:
+            return self.generator.random(size)
+        try:
+            return self._next()
+        except StopIteration:
+            self._next = iter(self.generator.random(self.block_size).tolist()).__next__
+            return self._next()
+
+    def randint(self, low, high):
+        ''' An int in [low, high), like numpy.random.randint. '''
+        return low + int(self.random() * (high - low))
+
+    def integers(self, low, high, size=None, dtype=np.int64):
+        ''' Ints in [low, high), like numpy.random.Generator.integers. '''
+        return self.generator.integers(low, high, size = size, dtype = dtype)
+
+    def shuffle(self, x):
+        ''' Shuffles a list or 1-d array in place. '''
+        self.generator.shuffle(x)
+
+    def permutation(self, n):
+        ''' A random ordering of range(n), as an array. '''
+        return self.generator.permutation(n)
@@ -0,0 +1,99 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+# Frame ring buffer layout, in one block of shared memory:
+#   counters: frames written (head), frames released by the reader (tail), frames skipped by the writer
+#   lengths:  the length of the frame in each slot
+#   slots:    fixed-size slots, each holding one frame
+COUNTERS = 3
+
+# Sent up the control pipe by the writer after each frame it publishes, so the reader can
+# sleep on the pipe instead of polling the ring. An empty message still marks the end of a run.
+READY = b'\x01'
+
+
+class FrameRing:
+    ''' A ring buffer of frames in shared memory, between one simulation process (the writer)
+        and the server (the reader). The writer copies each frame into a free slot and publishes
+        it by bumping head; the reader copies it straight out of the slot, with no pickling or pipe
+        in between, and frees it by bumping tail. Each side only ever writes its own counter.
+
+        A slot is never written while it may still be read, so when the reader falls behind and
+        the ring is full, the writer must either wait for room or skip the frame (see gen_ca);
+        skips are counted, and show as gaps in the generation numbers of the frames. '''
+
+    def __init__(self, shm, slots, slot_size):
+        self.shm = shm
+        self.slots = slots
+        self.slot_size = slot_size
+        self.counters = np.ndarray((COUNTERS,), dtype = np.uint64, buffer = shm.buf)
+        self.lengths = np.ndarray((slots,), dtype = np.uint32, buffer = shm.buf, offset = 8 * COUNTERS)
+        self.data = shm.buf[8 * COUNTERS + 4 * slots:]
+
+    @classmethod
+    def create(cls, slots, slot_size):
+        ''' A new, empty ring of slots slots of slot_size bytes. '''
+        shm = shared_memory.SharedMemory(create = True, size = 8 * COUNTERS + (4 + slot_size) * slots)
+        ring = cls(shm, slots, slot_size)
+        ring.counters[:] = 0
+        return ring
+
+    @classmethod
+    def attach(cls, name, slots, slot_size):
+        ''' The ring created elsewhere under this name. '''
+        # Simulation workers share their server's resource tracker (see ca_pool.WorkerPool), which
+        # lets go of the ring when its creator unlinks it; so there is nothing to unregister here.
+        shm = shared_memory.SharedMemory(name = name)
+        return cls(shm, slots, slot_size)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def close(self):
+        # Views into the shared memory have to go before it can be closed.
+        del self.counters, self.lengths, self.data
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+    # Writer side.
+
+    def has_room(self):
+        ''' Whether there is a free slot to write a frame into. '''
+        head, tail, _ = self.counters.tolist()
+        return head - tail < self.slots
+
+    def write(self, frame):
+        ''' Copies a frame into the next slot and publishes it; there must be room. '''
+        head = int(self.counters[0])
+        slot = head % self.slots
+        start = slot * self.slot_size
+        self.data[start:start + len(frame)] = frame
+        self.lengths[slot] = len(frame)
+        self.counters[0] = head + 1
+
+    def skip(self):
+        ''' Counts a frame that was dropped because the ring was full. '''
+        self.counters[2] += 1
+
+    def skipped(self):
+        return int(self.counters[2])
+
+    # Reader side.
+
+    def pending(self):
+        ''' How many frames are waiting to be read. '''
+        head, tail, _ = self.counters.tolist()
+        return head - tail
+
+    def peek(self):
+        ''' The oldest waiting frame, as a view into its slot; release the view before release() or close(). '''
+        slot = int(self.counters[1]) % self.slots
+        start = slot * self.slot_size
+        return self.data[start:start + int(self.lengths[slot])]
+
+    def release(self):
+        ''' Frees the slot of the oldest waiting frame, for the writer to reuse. '''
+        self.counters[1] += 1
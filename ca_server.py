@@ -1,88 +1,586 @@
 import aiohttp
 from aiohttp import web
-import ca_eco
-from multiprocessing import Process, Pipe
 import asyncio
+import collections
 import concurrent.futures
+import functools
+import json
+import math
+import os
+import secrets
+import struct
+import time
+import uuid
+from ca_frames import PHASES, PROFILE_TAG, STATS_TAG, decode_profile, decode_stats, max_frame_size
+from ca_ring import FrameRing
+from ca_pool import WorkerPool
+from ca_history import RunHistory, prune
+from ca_metrics import Counter, Gauge, Histogram, Registry
+
+# Frame slots in each run's ring buffer.
+RING_SLOTS = 8
+
+# The biggest world a client can ask for; its ring takes RING_SLOTS frames of up to MAX_N x MAX_N bytes.
+MAX_N = 8192
+
+# Where the frames of every run are kept, taking up to this much disk, and the most of them one
+# request can ask for. Half of it is for the runs being recorded, split evenly among the pool's
+# workers, as no more runs than that are ever recorded at once: each stops being recorded once it
+# has taken its share. The other half is for the runs done, the ones used least recently being
+# thrown away first.
+RUNS_FOLDER = './runs'
+RUNS_BYTES = 1 << 30
+MAX_FRAMES_PER_REQUEST = 1000
+
+# The ids of the runs being recorded, which are never thrown away (nor counted, see prune).
+RECORDING = set()
+
+# Seeded runs are cached here (see ca_cache), taking up to this much disk.
+CACHE_FOLDER = './cache'
+CACHE_BYTES = 1 << 30
+
+# How critters take their moves (see ca_eco.MODES): a sublattice at a time, all at once, which
+# goes by the critters alone, not every cell, while they are sparse (see ca_eco.SPARSE_OCCUPANCY).
+MODE = 'sublattice'
+
+# Worlds this big and bigger are split among this many processes each (see ca_domain), as many as
+# the pool has workers at most; each takes up one of them while the run lasts.
+DOMAIN_N = 2048
+DOMAIN_WORKERS = os.cpu_count()
+
+# What the server is doing, served at /metrics (see ca_metrics).
+METRICS = Registry()
+WEBSOCKETS = METRICS.add(Gauge('ca_websockets', 'WebSocket connections open.'))
+RUNS_STARTED = METRICS.add(Counter('ca_runs_started_total', 'Runs started, or put in line for a worker.'))
+RUNS_TURNED_AWAY = METRICS.add(Counter('ca_runs_turned_away_total', 'Runs turned away with too many in line already.'))
+RUNS_FAILED = METRICS.add(Counter('ca_runs_failed_total', 'Runs whose worker died.'))
+SIMULATIONS = METRICS.add(Gauge('ca_simulations_running', 'Workers running a simulation.',
+                                function = lambda: {(): app['pool'].busy()}))
+QUEUED = METRICS.add(Gauge('ca_runs_queued', 'Runs in line for a worker.', function = lambda: {(): app['pool'].queued()}))
+WORKERS = METRICS.add(Gauge('ca_workers', 'Simulation workers.', function = lambda: {(): app['pool'].size}))
+PIPE_BACKLOG = METRICS.add(Histogram('ca_pipe_messages_per_wakeup',
+                                     'Messages waiting on a run\'s control pipe each time the server woke up for them.',
+                                     [1, 2, 4, 8, 16, 32, 64]))
+FRAMES_SENT = METRICS.add(Counter('ca_frames_sent_total', 'Frames sent to clients.'))
+BYTES_SENT = METRICS.add(Counter('ca_bytes_sent_total', 'Bytes sent to clients, as frames or JSON messages.', ('kind',)))
+SEND_LATENCY = METRICS.add(Histogram('ca_send_seconds',
+                                     'Time taken to send a frame, including waiting for a slow client to take it.',
+                                     [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5]))
+JSON_ENCODE = METRICS.add(Histogram('ca_json_encode_seconds', 'Time taken to encode a JSON message.',
+                                    [0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005]))
+
+# The RunMeter of every run going, by run id, for the metrics of each run.
+RUN_METERS = {}
+
+def per_run(value):
+    return lambda: {(meter.run, meter.client): value(meter) for meter in RUN_METERS.values()}
+
+RUN_FPS = METRICS.add(Gauge('ca_run_fps', 'Frames sent to the run\'s client in the last second.', ('run', 'client'),
+                            per_run(lambda meter: meter.fps())))
+RUN_BACKLOG = METRICS.add(Gauge('ca_run_ring_backlog', 'Frames of the run waiting for its client to be ready.',
+                                ('run', 'client'), per_run(lambda meter: meter.ring.pending())))
+RUN_FRAMES = METRICS.add(Counter('ca_run_frames_sent_total', 'Frames of the run sent to its client.', ('run', 'client'),
+                                 per_run(lambda meter: meter.frames)))
+RUN_BYTES = METRICS.add(Counter('ca_run_bytes_sent_total', 'Bytes of frames of the run sent to its client.',
+                                ('run', 'client'), per_run(lambda meter: meter.bytes)))
+RUN_SEND_SECONDS = METRICS.add(Counter('ca_run_send_seconds_total', 'Time spent sending frames of the run to its client.',
+                                       ('run', 'client'), per_run(lambda meter: meter.send_seconds)))
 
 async def handle_index(request):
     return web.FileResponse('./static/index.html')
 
-async def poll_results(pipe, ws):
-    while True:
-        if ws.closed:
-            return
-        if not pipe.poll():
-            await asyncio.sleep(0.1)
-            continue
-        frame = pipe.recv()
-        if frame is None:
-            await ws.send_json({
-                'type': 'finish',
-            })
-            return
-        else:
-            await ws.send_json({
-                'type': 'data',
-                'value': frame,
+# What the simulation does when the client is not ready for its frames: wait for it, or
+# carry on and drop them. Maps the client's policy to gen_ca's when_full.
+POLICIES = {
+    'throttle': 'wait',
+    'drop': 'skip',
+}
+
+class FlowControl:
+    ''' How fast the client wants frames. With no flow control, every frame goes out as soon as
+        it is ready. The client can instead grant credits, one per frame it is ready for, topping
+        them up as it renders, and can ask for at most fps frames a second. Frames the client is
+        not ready for wait in the ring; once that is full, the run's policy applies. '''
+
+    def __init__(self, credits=None, fps=None):
+        # Set whenever something may have changed: a message from the simulation, more credit, or time passing.
+        self.wakeup = asyncio.Event()
+        self.timer = None
+        self.credits = credits
+        self.next_send = 0.0
+        self.set_fps(fps)
+
+    def grant(self, frames):
+        self.credits = (self.credits or 0) + frames
+        self.wakeup.set()
+
+    def set_fps(self, fps):
+        self.interval = 1 / fps if fps else 0.0
+        self.wakeup.set()
+
+    def ready(self):
+        ''' Whether the next frame can go out now; if it is only early, wakes up when it is due. '''
+        if self.credits == 0:
+            return False
+        loop = asyncio.get_running_loop()
+        delay = self.next_send - loop.time()
+        if delay > 0:
+            if self.timer is None:
+                self.timer = loop.call_later(delay, self._due)
+            return False
+        return True
+
+    def _due(self):
+        self.timer = None
+        self.wakeup.set()
+
+    def sent(self):
+        if self.credits is not None:
+            self.credits -= 1
+        self.next_send = asyncio.get_running_loop().time() + self.interval
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+
+class RunMeter:
+    ''' What a run has sent its client (at the address client), for /metrics. '''
+
+    def __init__(self, run, client, ring):
+        self.run = run
+        self.client = client
+        self.ring = ring
+        self.frames = 0
+        self.bytes = 0
+        self.send_seconds = 0.0
+        # When each frame of the last second went out.
+        self.recent = collections.deque()
+
+    def sent(self, size, seconds):
+        FRAMES_SENT.inc()
+        BYTES_SENT.inc(size, 'frames')
+        SEND_LATENCY.observe(seconds)
+        self.frames += 1
+        self.bytes += size
+        self.send_seconds += seconds
+        self.recent.append(time.monotonic())
+        self.fps()
+
+    def fps(self):
+        ''' Frames sent in the last second. '''
+        since = time.monotonic() - 1
+        while self.recent and self.recent[0] < since:
+            self.recent.popleft()
+        return len(self.recent)
+
+async def send_json(ws, message):
+    # ws.send_json, timing the encoding and counting the bytes for /metrics.
+    start = time.perf_counter()
+    data = json.dumps(message)
+    JSON_ENCODE.observe(time.perf_counter() - start)
+    BYTES_SENT.inc(len(data), 'json')
+    await ws.send_str(data)
+
+async def send_frames(ring, ws, flow, history, meter, flush=False):
+    # Send the frames that are ready, as far as the client is, each copied out of shared memory
+    # and its slot freed before it is sent: a socket's transport may keep what it is given until
+    # a slow client has taken it, and the simulation would write over a slot still queued there.
+    # Then add them to the run's history. flush sends whatever is left at the end of a run
+    # regardless. With the client gone, frames are just recorded until the run has stopped.
+    frames = []
+    while ring.pending() and (flush or ws.closed or flow.ready()):
+        with ring.peek() as view:
+            frame = bytes(view)
+        ring.release()
+        frames.append(frame)
+        if not ws.closed:
+            start = time.perf_counter()
+            try:
+                await ws.send_bytes(frame)
+            except ConnectionResetError:
+                pass
+            else:
+                meter.sent(len(frame), time.perf_counter() - start)
+        flow.sent()
+    if frames:
+        # Off the event loop, where a slow disk would hold up every client; the run waits for it,
+        # so its frames are written in order and no faster than the disk takes them.
+        await asyncio.get_running_loop().run_in_executor(None, history.extend, frames)
+
+def stats_message(message):
+    # Population stats or a profile of a step, from the simulation, as a message for the client.
+    if message[:1] == STATS_TAG:
+        generation, counts, fitness = decode_stats(message)
+        return {
+            'type': 'stats',
+            'generation': generation,
+            'counts': counts,
+            'fitness': fitness,
+        }
+    generation, seconds, counts = decode_profile(message)
+    return {
+        'type': 'profile',
+        'generation': generation,
+        'ms': {phase: 1000 * time for phase, time in zip(PHASES, seconds)},
+        'counts': dict(zip(PHASES, counts)),
+    }
+
+async def poll_results(pipe, ring, ws, flow, history, meter):
+    # Sleep until the simulation says something up the pipe or the client is ready for more,
+    # rather than polling. Returns whether the run ended properly (rather than its worker dying).
+    loop = asyncio.get_running_loop()
+    loop.add_reader(pipe.fileno(), flow.wakeup.set)
+    try:
+        while True:
+            await flow.wakeup.wait()
+            flow.wakeup.clear()
+
+            # Take every message waiting: READY for each frame in the ring, population stats and
+            # profiles if subscribed to, and an empty one at the end, followed by a summary of the run.
+            finished = False
+            stats = []
+            taken = 0
+            try:
+                while not finished and pipe.poll():
+                    message = pipe.recv_bytes()
+                    taken += 1
+                    finished = message == b''
+                    if message[:1] in (STATS_TAG, PROFILE_TAG):
+                        stats.append(message)
+            except EOFError:
+                # The simulation died without saying goodbye.
+                return False
+            if taken:
+                PIPE_BACKLOG.observe(taken)
+
+            # Stats are small, and go out as they come, whatever the flow control on frames.
+            for message in stats:
+                if ws.closed:
+                    break
+                await send_json(ws, stats_message(message))
+
+            # However many frames are ready, send them all in this one wakeup.
+            await send_frames(ring, ws, flow, history, meter, flush = finished)
+            if finished:
+                summary = pipe.recv()
+                if not ws.closed:
+                    await send_json(ws, {
+                        'type': 'finish',
+                        'summary': summary,
+                    })
+                return True
+    finally:
+        loop.remove_reader(pipe.fileno())
+
+def domain_workers(n, pool):
+    # How many processes to split a world of n x n among, or None to run it in its worker alone.
+    workers = min(DOMAIN_WORKERS, pool.size)
+    return workers if n >= DOMAIN_N and workers > 1 else None
+
+async def run_simulation(pool, run, job, ring, ws, flow, history, meter):
+    # Tell the client about the run, wait in line for a worker (one per process of a split world),
+    # then relay the run's frames until it ends, and hand the workers back. What else the run
+    # took, end_run gives back.
+    if not ws.closed:
+        # reset graph and set new params
+        await send_json(ws, {
+            'type': 'setup',
+            'n': job['n'],
+            'run': history.run,
+            'seed': job['seed'],
+        })
+        if pool.queued():
+            await send_json(ws, {
+                'type': 'queued',
+                'position': pool.queued(),
             })
+    await pool.start(run, job['workers'] or 1, **job)
+    if await poll_results(run.pipe, ring, ws, flow, history, meter):
+        pool.release(run)
+    else:
+        RUNS_FAILED.inc()
+        await pool.replace(run)
+
+def end_run(pool, run, ring, flow, history, meter, task):
+    # Called once the task of a run is done, however it ended: even cancelled before it ever got
+    # to run_simulation, when none of that ran (a stop in the same read as the start). Takes the
+    # run out of line if it is still in it, and gives back its ring, its history and its meter.
+    pool.withdraw(run)
+    del RUN_METERS[meter.run]
+    flow.cancel()
+    ring.close()
+    ring.unlink()
+    history.close()
+    history.touch()
+    RECORDING.discard(history.run)
+    # Make room for the next runs; off the event loop, as that means looking at every run recorded.
+    asyncio.get_running_loop().run_in_executor(None, prune, RUNS_FOLDER, RUNS_BYTES // 2, RECORDING)
+
+async def stop_simulation(run, task):
+    # Stop a run, whether it is still in line for a worker or already running, and wait for it to end.
+    if task is None or task.done():
+        return
+    if run.started():
+        run.stop()
+    else:
+        task.cancel()
+    try:
+        # Shielded: aiohttp cancels the handler of a socket that has gone, and cancelling a run
+        # mid-relay would keep its workers from ever being handed back.
+        await asyncio.shield(task)
+    except asyncio.CancelledError:
+        # The run's own cancelling is expected; the handler's is passed on.
+        if not task.cancelled():
+            raise
+
+def is_int(value, low=None, high=None):
+    # Whether a value from a client's JSON is a whole number (not a bool), from low up to high if given.
+    return (isinstance(value, int) and not isinstance(value, bool) and
+            (low is None or value >= low) and (high is None or value <= high))
+
+def is_number(value, low=None, high=None):
+    # Whether a value from a client's JSON is a finite number (not a bool), from low up to high if given.
+    return (isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value) and
+            (low is None or value >= low) and (high is None or value <= high))
+
+def check_start(payload):
+    # What is wrong with a start message, if anything: whatever would make the simulation, or the
+    # setting up of its run, choke, and worlds too big to give a ring to.
+    if not is_int(payload.get('n'), 3, MAX_N):
+        return 'n must be a whole number from 3 to %d' % MAX_N
+    if not (is_number(payload.get('p'), 0, 1) and is_number(payload.get('q'), 0, 1) and payload['p'] + payload['q'] <= 1):
+        return 'p and q must be numbers from 0 to 1, together no more than 1'
+    if not (payload.get('seed') is None or is_int(payload['seed'], 0)):
+        return 'seed must be a whole number, 0 or more, or null'
+    if not (payload.get('viewport') is None or is_int(payload['viewport'], 1)):
+        return 'viewport must be a whole number, 1 or more, or null'
+    if payload.get('policy', 'throttle') not in POLICIES:
+        return 'policy must be one of %s' % ', '.join(sorted(POLICIES))
+    if not (payload.get('credits') is None or is_int(payload['credits'], 0)):
+        return 'credits must be a whole number, 0 or more, or null'
+    if not (payload.get('fps') is None or is_number(payload['fps'], 0)):
+        return 'fps must be a number, 0 or more, or null'
+    for channel in ('frames', 'stats', 'profile'):
+        if not isinstance(payload.get(channel, False), bool):
+            return '%s must be true or false' % channel
+    return None
+
+def check_region(region):
+    # What is wrong with a zoom region, if anything: it must be null, or three whole numbers
+    # [top, left, size], which ca_frames.view fits to the world.
+    if region is None or (isinstance(region, list) and len(region) == 3 and all(is_int(value) for value in region)):
+        return None
+    return 'region must be [top, left, size], whole numbers, or null'
 
 async def handle_websocket(request):
     ws = web.WebSocketResponse()
     await ws.prepare(request)
 
     print('websocket connection opened')
+    WEBSOCKETS.inc()
 
+    pool = request.app['pool']
     poll_task = None
-    pipe = None
-
-    async for msg in ws:
-        if msg.type == aiohttp.WSMsgType.TEXT:
-            if msg.data == 'close':
-                await ws.close()
-                if pipe:
-                    pipe.send(None)
-                    await poll_task
-                continue
-            payload = msg.json()
-            if payload['type'] == 'start':
-                if poll_task and not poll_task.done():
-                    pipe.send(None)
-                    await poll_task
-
-                n = payload['n']
-                p = payload['p']
-                q = payload['q']
-                # reset graph and set new params
-                await ws.send_json({
-                    'type': 'setup',
-                    'n': n,
-                })
-
-                conn1, conn2 = Pipe(True)
-                pipe = conn1
-                Process(target=ca_eco.gen_ca, args=(n, p, q, conn2)).start()
-                poll_task = asyncio.create_task(poll_results(pipe, ws))
-
-            elif payload['type'] == 'stop':
-                if pipe:
-                    pipe.send(None)
-                    await poll_task
-
-        elif msg.type == aiohttp.WSMsgType.ERROR:
-            print('ws connection closed with exception %s' %
-                ws.exception())
+    run = None
+    flow = None
+
+    try:
+        async for msg in ws:
+            if msg.type == aiohttp.WSMsgType.TEXT:
+                if msg.data == 'close':
+                    await ws.close()
+                    await stop_simulation(run, poll_task)
+                    continue
+                payload = msg.json()
+                if payload['type'] == 'start':
+                    # A start the simulation could not run is turned down, before it takes a place in line.
+                    problem = check_start(payload)
+                    if problem:
+                        await send_json(ws, {
+                            'type': 'invalid',
+                            'message': problem,
+                        })
+                        continue
+                    await stop_simulation(run, poll_task)
+
+                    # Too many runs already waiting for a worker: turn this one away.
+                    if pool.full():
+                        run = poll_task = None
+                        RUNS_TURNED_AWAY.inc()
+                        await send_json(ws, {
+                            'type': 'busy',
+                        })
+                        continue
+
+                    # From here until the run's task is made, nothing waits: the place in line taken
+                    # last is still free, and the run's task, once it ends, gives back all the rest.
+                    n = payload['n']
+                    p = payload['p']
+                    q = payload['q']
+                    # Every run is seeded, so it can be had again, from the cache, by asking for its seed.
+                    seed = payload.get('seed')
+                    if seed is None:
+                        seed = secrets.randbits(32)
+                    # Frames come back through a ring buffer in shared memory; the pipe is for control.
+                    ring = FrameRing.create(RING_SLOTS, max_frame_size(n))
+                    # Every run's frames are kept on disk, under an id of its own (see handle_run_frames).
+                    # It is marked as being recorded before there is anything of it to throw away.
+                    run_id = uuid.uuid4().hex
+                    RECORDING.add(run_id)
+                    try:
+                        history = RunHistory.create(RUNS_FOLDER, run_id, {
+                            'n': n,
+                            'p': p,
+                            'q': q,
+                            'seed': seed,
+                            'mode': MODE,
+                        }, RUNS_BYTES // (2 * pool.size))
+                    except BaseException:
+                        RECORDING.discard(run_id)
+                        ring.close()
+                        ring.unlink()
+                        raise
+                    flow = FlowControl(payload.get('credits'), payload.get('fps'))
+                    job = {
+                        'n': n,
+                        'p': p,
+                        'q': q,
+                        'seed': seed,
+                        'mode': MODE,
+                        'cache': CACHE_FOLDER,
+                        'cache_bytes': CACHE_BYTES,
+                        'ring': ring.name,
+                        'ring_slots': RING_SLOTS,
+                        'when_full': POLICIES[payload.get('policy', 'throttle')],
+                        # Frames need be no more cells across than the client has pixels.
+                        'viewport': payload.get('viewport'),
+                        # Frames, population stats, profiles of each step, or any mix of them;
+                        # a 'subscribe' message changes this mid-run.
+                        'frames': payload.get('frames', True),
+                        'stats': payload.get('stats', False),
+                        'profile': payload.get('profile', False),
+                        'workers': domain_workers(n, pool),
+                    }
+                    meter = RunMeter(history.run, request.remote, ring)
+                    run = pool.submit()
+                    RUNS_STARTED.inc()
+                    RUN_METERS[meter.run] = meter
+                    poll_task = asyncio.create_task(run_simulation(pool, run, job, ring, ws, flow, history, meter))
+                    poll_task.add_done_callback(functools.partial(end_run, pool, run, ring, flow, history, meter))
+
+                elif payload['type'] == 'zoom':
+                    # Show the square region [top, left, size] of the world, or all of it if null.
+                    problem = check_region(payload.get('region'))
+                    if problem:
+                        await send_json(ws, {
+                            'type': 'invalid',
+                            'message': problem,
+                        })
+                    elif run:
+                        run.send(('zoom', payload.get('region')))
+
+                elif payload['type'] == 'subscribe':
+                    # Turn frames, population stats or profiles on or off for the rest of the run.
+                    if run:
+                        run.send(('subscribe', {
+                            channel: bool(payload[channel]) for channel in ('frames', 'stats', 'profile') if channel in payload
+                        }))
+
+                elif payload['type'] == 'credit':
+                    if not is_int(payload.get('frames'), 0):
+                        await send_json(ws, {
+                            'type': 'invalid',
+                            'message': 'frames must be a whole number, 0 or more',
+                        })
+                    elif flow:
+                        flow.grant(payload['frames'])
+
+                elif payload['type'] == 'fps':
+                    if not (payload.get('fps') is None or is_number(payload['fps'], 0)):
+                        await send_json(ws, {
+                            'type': 'invalid',
+                            'message': 'fps must be a number, 0 or more, or null',
+                        })
+                    elif flow:
+                        flow.set_fps(payload['fps'])
+
+                elif payload['type'] == 'stop':
+                    await stop_simulation(run, poll_task)
+
+            elif msg.type == aiohttp.WSMsgType.ERROR:
+                print('ws connection closed with exception %s' %
+                    ws.exception())
+    finally:
+        WEBSOCKETS.inc(-1)
+        # The client is gone, or the handler failed; free its worker for someone else.
+        await stop_simulation(run, poll_task)
 
     print('websocket connection closed')
 
     return ws
 
+def open_history(request):
+    history = RunHistory.open(RUNS_FOLDER, request.match_info['run'])
+    if history is None:
+        raise web.HTTPNotFound()
+    try:
+        history.touch()
+    except FileNotFoundError:
+        # Thrown away just now (see prune).
+        raise web.HTTPNotFound()
+    return history
+
+async def handle_run(request):
+    # What a recorded run was started with, and which generations it has.
+    history = open_history(request)
+    generations = history.index()['generation']
+    info = history.params()
+    info.update({
+        'run': history.run,
+        'frames': len(generations),
+        'first': int(generations[0]) if len(generations) else None,
+        'last': int(generations[-1]) if len(generations) else None,
+    })
+    history.close()
+    return web.json_response(info)
+
+async def handle_run_frames(request):
+    # The frames of generations start up to stop (not included, start + 1 by default) of a run,
+    # the first a keyframe, each preceded by its length (uint32, little-endian).
+    history = open_history(request)
+    try:
+        start = int(request.query['start'])
+        stop = min(int(request.query.get('stop', start + 1)), start + MAX_FRAMES_PER_REQUEST)
+    except (KeyError, ValueError):
+        raise web.HTTPBadRequest(text = 'start (and stop) must be generation numbers')
+
+    # Seeking may mean decoding a few frames; keep that off the event loop.
+    frames = await asyncio.get_running_loop().run_in_executor(None, history.frames, start, stop)
+    history.close()
+    return web.Response(
+        body = b''.join(struct.pack('<I', len(frame)) + frame for frame in frames),
+        content_type = 'application/octet-stream',
+    )
+
+async def handle_metrics(request):
+    # What the server is doing, in the Prometheus text format.
+    return web.Response(text = METRICS.render(), content_type = 'text/plain')
+
+async def close_pool(app):
+    app['pool'].close()
+
 app = web.Application()
 app.router.add_static('/static', './static')
 app.add_routes([
     web.get('/', handle_index),
     web.get('/socket', handle_websocket),
+    web.get('/runs/{run}', handle_run),
+    web.get('/runs/{run}/frames', handle_run_frames),
+    web.get('/metrics', handle_metrics),
 ])
+app.on_cleanup.append(close_pool)
 
 if __name__ == '__main__':
-    web.run_app(app)
\ No newline at end of file
+    # Start the simulation workers, and the fork server that starts them, before the server opens any sockets.
+    app['pool'] = WorkerPool()
+    web.run_app(app)
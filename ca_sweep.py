@@ -0,0 +1,129 @@
+import argparse
+import concurrent.futures
+import itertools
+import json
+import os
+import numpy as np
+import ca_eco
+from ca_cache import cache_key
+from ca_random import RandomSource
+
+# Runs a grid of ca_eco runs, without the server, on all cores:
+#
+#   python ca_sweep.py --out sweep --n 128 --p 0.01 0.02 --q 0.2 --seeds 10 --generations 500 \
+#       --rule prey_birth_threshold=9,11
+#
+# Each run's population of every cell type, generation by generation, is saved to
+# <out>/runs/<key>.npz as soon as the run is done, so an interrupted sweep carries on where it
+# left off when run again; then all of them are put together in <out>/populations.npz, one
+# column per field (see combine).
+
+TYPES = 8
+
+
+def parse_rule(text):
+    ''' "name=v1,v2,..." as (name, [v1, v2, ...]). '''
+    name, _, values = text.partition('=')
+    if name not in ca_eco.RULES or not values:
+        raise argparse.ArgumentTypeError('expected name=value,... with name one of ' + ', '.join(ca_eco.RULES))
+    kind = type(ca_eco.RULES[name])
+    return name, [kind(value) for value in values.split(',')]
+
+
+def sweep_runs(args):
+    ''' Every run of the sweep, as the parameters it is made with. '''
+    rule_names = [name for name, _ in args.rule]
+    seeds = args.seed if args.seed else range(args.seeds)
+    runs = []
+    for n, p, q, values, seed in itertools.product(args.n, args.p, args.q,
+                                                   itertools.product(*(values for _, values in args.rule)), seeds):
+        runs.append({
+            'model': 'eco',
+            'engine': args.engine,
+            'mode': args.mode,
+            'n': n,
+            'p': p,
+            'q': q,
+            'rules': ca_eco.rules_with(dict(zip(rule_names, values))),
+            'seed': seed,
+            'generations': args.generations,
+        })
+    return runs
+
+
+def simulate(params):
+    ''' The population of each cell type in every generation of a run, as a (generations + 1) x 8 array. '''
+    rng = RandomSource(params['seed'])
+    W = ca_eco.init_world(params['n'], params['p'], params['q'], rng.generator)
+    index = ca_eco.CellIndex(W)
+
+    counts = np.zeros((params['generations'] + 1, TYPES), dtype = np.uint32)
+    counts[0] = np.bincount(W[:, :, 0].ravel(), minlength = TYPES)
+    for generation in range(1, params['generations'] + 1):
+        W = ca_eco.time_step(W, index, params['engine'], params['mode'], rng, params['rules'])
+        counts[generation] = np.bincount(W[:, :, 0].ravel(), minlength = TYPES)
+    return counts
+
+
+def save_run(folder, params, counts):
+    path = os.path.join(folder, cache_key(params) + '.npz')
+    # Written in full before it is given its name, so a run cut short is never taken as done.
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, params = json.dumps(params), counts = counts)
+    os.replace(path + '.tmp', path)
+
+
+def combine(folder, runs):
+    ''' The population series of these runs as columns: run (its place in runs), n, p, q, seed,
+        every rule constant, generation, and count_0 to count_7, one row per run and generation. '''
+    columns = {}
+    for run, params in enumerate(runs):
+        with np.load(os.path.join(folder, cache_key(params) + '.npz')) as saved:
+            counts = saved['counts']
+        rows = len(counts)
+        fields = {'run': run, 'n': params['n'], 'p': params['p'], 'q': params['q'], 'seed': params['seed']}
+        fields.update(params['rules'])
+        for name, value in fields.items():
+            columns.setdefault(name, []).append(np.full(rows, value))
+        columns.setdefault('generation', []).append(np.arange(rows))
+        for cell_type in range(TYPES):
+            columns.setdefault('count_%d' % cell_type, []).append(counts[:, cell_type])
+    return {name: np.concatenate(parts) for name, parts in columns.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Run a grid of ca_eco runs on all cores, saving their population series.')
+    parser.add_argument('--out', required = True, help = 'folder to save the sweep in')
+    parser.add_argument('--n', type = int, nargs = '+', default = [128], help = 'world sizes')
+    parser.add_argument('--p', type = float, nargs = '+', default = [0.02], help = 'initial shares of predators')
+    parser.add_argument('--q', type = float, nargs = '+', default = [0.2], help = 'initial shares of prey')
+    parser.add_argument('--rule', type = parse_rule, action = 'append', default = [],
+                        help = 'values of a rule constant to try, as name=v1,v2,... (repeatable)')
+    parser.add_argument('--seeds', type = int, default = 1, help = 'runs per grid point, seeded 0, 1, ...')
+    parser.add_argument('--seed', type = int, nargs = '+', help = 'the seeds to use instead')
+    parser.add_argument('--generations', type = int, default = 500)
+    parser.add_argument('--engine', choices = sorted(ca_eco.ENGINES), default = 'numpy')
+    parser.add_argument('--mode', choices = sorted(ca_eco.MODES), default = 'sequential')
+    parser.add_argument('--workers', type = int, default = os.cpu_count())
+    args = parser.parse_args()
+
+    folder = os.path.join(args.out, 'runs')
+    os.makedirs(folder, exist_ok = True)
+    runs = sweep_runs(args)
+    todo = [params for params in runs if not os.path.exists(os.path.join(folder, cache_key(params) + '.npz'))]
+    print('%d runs, %d done already' % (len(runs), len(runs) - len(todo)))
+
+    with concurrent.futures.ProcessPoolExecutor(args.workers) as pool:
+        futures = {pool.submit(simulate, params): params for params in todo}
+        for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            save_run(folder, futures[future], future.result())
+            print('%d/%d runs done' % (done, len(todo)), end = '\r', flush = True)
+    print()
+
+    path = os.path.join(args.out, 'populations.npz')
+    np.savez(path, **combine(folder, runs))
+    print('population series saved to', path)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,35 +1,41 @@
 import numpy as np
-from numpy.random import rand, randint
+from ca_random import RandomSource
 from copy import deepcopy
 import asyncio
 import concurrent.futures
 
 # Function to initialize a random world of 3 types of cells.
-def init_world(n, p, q):
+def init_world(n, p, q, rng=None):
     ''' Input n: the dimensions of the world is nxn
               p, q:  probability of types S and M; Prob(type D) = 1 - p - q 
+              rng: a numpy.random.Generator, pass a seeded one to reproduce a world
         Output: an initialized numpy array, with 1 for all type S, 2 for type M, and 3 for type D cells. '''
+    if rng is None:
+        rng = np.random.default_rng()
 
     W = 3 * np.ones((n, n, 2), dtype = np.uint8)  # type D
 
-    for i in range(n):
-        for j in range(n):
-            r = rand()
-            if r < p:
-                W[i, j, 0] = 1   # type S
-            elif r < p + q:
-                W[i, j, 0] = 2   # type M
-            #else it's already 3, for type D
-
-            W[i, j, 1] = randint(0, 5)   # food counter (satiation)
+    # Draw every cell's dice at once.
+    r = rng.random((n, n))
+    W[r < p, 0] = 1                  # type S
+    W[(r >= p) & (r < p + q), 0] = 2  # type M
+    #else it's already 3, for type D
+
+    W[:, :, 1] = rng.integers(0, 5, size = (n, n), dtype = np.uint8)   # food counter (satiation)
     return W
 
 
-# Function to compute next generation.
-def time_step(W):
-    ''' Update the state of the world by one time step.'''
+# Reference engine: the original cell-by-cell loop, kept for checking the fast engine.
+def time_step_reference(W, M=None, rng=None):
+    ''' Update the state of the world by one time step, one cell at a time.
+        If M is given, the new generation is written into it instead of a fresh copy.'''
     n = W.shape[0]
-    M = deepcopy(W)
+    if rng is None:
+        rng = RandomSource()
+    if M is None:
+        M = deepcopy(W)
+    else:
+        M[...] = W
     
     # For each cell, 
     for i in range(n):
@@ -50,7 +56,7 @@ def time_step(W):
                 
                 # Check to see if the best was 0, which implies ???
                 if best_type == 0:
-                    best_type = randint(1, 3)   # pick a valid one at random then
+                    best_type = rng.randint(1, 3)   # pick a valid one at random then
                 M[i, j, 0] = best_type
                 M[i, j, 1] = 4    # not born hungry!
                 
@@ -58,22 +64,104 @@ def time_step(W):
     for i in range(n):
         for j in range(n):
             M[i, j, 1] -= 1
-    return M  
+    return M
+
+
+# Scratch buffers for the vectorized engine, allocated once per grid size.
+_scratch = {}
+
+def _get_scratch(n):
+    if n not in _scratch:
+        _scratch[n] = {
+            # Fitness of each type (axis 0, index 0 unused) with a one cell wrap-around border.
+            'padded': np.zeros((4, n + 2, n + 2), dtype = np.uint16),
+            # Partial sums over the 3 rows of each neighborhood.
+            'rows': np.zeros((4, n, n + 2), dtype = np.uint16),
+            # Full 3x3 neighborhood sums.
+            'sums': np.zeros((4, n, n), dtype = np.uint16),
+        }
+    return _scratch[n]
+
+
+# Vectorized engine: the same rule as time_step_reference, a whole grid at a time.
+def time_step_numpy(W, M=None, rng=None):
+    ''' Update the state of the world by one time step using whole-array operations.
+        The new generation is written into M (allocated if not given), W is left untouched. '''
+    n = W.shape[0]
+    if rng is None:
+        rng = RandomSource()
+    if M is None:
+        M = np.empty_like(W)
+    s = _get_scratch(n)
+    padded, rows, sums = s['padded'], s['rows'], s['sums']
+    types, fitness = W[:, :, 0], W[:, :, 1]
+
+    # Spread the fitness of each cell into the plane for its type.
+    for t in range(1, 4):
+        np.multiply(types == t, fitness, out = padded[t, 1:-1, 1:-1])
+
+    # Wrap the borders around, so the world is a torus (same as the % n arithmetic).
+    padded[:, 0, 1:-1] = padded[:, n, 1:-1]
+    padded[:, n + 1, 1:-1] = padded[:, 1, 1:-1]
+    padded[:, :, 0] = padded[:, :, n]
+    padded[:, :, n + 1] = padded[:, :, 1]
+
+    # Tally up the fitness of each type over every 3x3 neighborhood.
+    np.add(padded[:, :-2], padded[:, 1:-1], out = rows)
+    np.add(rows, padded[:, 2:], out = rows)
+    np.add(rows[:, :, :-2], rows[:, :, 1:-1], out = sums)
+    np.add(sums, rows[:, :, 2:], out = sums)
+
+    # More successful neighbors replace starved cells with their type.
+    # argmax returns the first maximum, just like types.index(max(types)).
+    best_type = sums.argmax(axis = 0)
+    starved = fitness == 0
+
+    # A best type of 0 means an empty tally: pick a valid one at random. These are few, and are
+    # drawn one at a time in row-major order, as the reference does, so both draw the same types.
+    no_winner = starved & (best_type == 0)
+    best_type[no_winner] = [rng.randint(1, 3) for _ in range(np.count_nonzero(no_winner))]
+
+    np.copyto(M[:, :, 0], types)
+    np.copyto(M[:, :, 0], best_type, where = starved, casting = 'unsafe')
+
+    # Everyone has burned some calories (starved cells were born with 4).
+    np.subtract(fitness, 1, out = M[:, :, 1], where = ~starved, casting = 'unsafe')
+    M[:, :, 1][starved] = 3
+    return M
+
+
+ENGINES = {
+    'reference': time_step_reference,
+    'numpy': time_step_numpy,
+}
+
+
+# Function to compute next generation.
+def time_step(W, M=None, engine='numpy', rng=None):
+    ''' Update the state of the world by one time step with the chosen engine.
+        rng is the run's RandomSource; pass the same one every step to reproduce a run.'''
+    return ENGINES[engine](W, M, rng)
+
+async def gen_ca(n, p, q, results_queue, engine='numpy', seed=None):
 
-async def gen_ca(n, p, q, results_queue):
+    # All of this run's random numbers come from here.
+    rng = RandomSource(seed)
 
     # Initialize the world.
-    W = init_world(n, p, q)
+    W = init_world(n, p, q, rng.generator)
+    # Second buffer; each step writes into it and then the two are swapped.
+    M = np.empty_like(W)
 
     results_queue.put( W[:, :, 0].tolist() )
     # A maximum of 100 iterations if steady state isn't found first.
     for im in range(1, 100):
-        M = time_step(W)
+        M = time_step(W, M, engine, rng)
         
         # Check to see if we've likely entered a steady state.
         if np.array_equal(W[:, :, 0], M[:, :, 0]):  break
                 
-        W = deepcopy(M)
+        W, M = M, W
         
         results_queue.put( W[:, :, 0].tolist() )
     
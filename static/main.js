@@ -3,31 +3,85 @@ window.addEventListener('load', () => {
     const pred_input      = document.getElementById('pred_input');
     const prey_input      = document.getElementById('prey_input');
     const plant_input     = document.getElementById('plant_input');
+    const seed_input      = document.getElementById('seed_input');
     const start_ca_button = document.getElementById('start_ca');
     const stop_ca_button  = document.getElementById('stop_ca');
     const frame_slider    = document.getElementById('frame_slider');
     const gen_nr          = document.getElementById('gen_nr');
+    const population      = document.getElementById('population');
 
     const chart = new CAChart();
     const socket = new ReconnectingJSONWebsocket('ws://localhost:8080/socket');
 
+    // Flow control: the server only sends as many frames as we have granted credits for.
+    // We start with FRAME_CREDITS and hand them back in batches as frames get drawn.
+    const FRAME_CREDITS = 8;
+    const CREDIT_BATCH = 4;
+    let drawn = 0;
+
+    // The part of the world the last frame showed, and how big the world is.
+    let view = null;
+    let world_size = null;
+
+    // The run being shown, whose frames the server keeps, so the slider can go back to any of them.
+    let run = null;
+    // Counts slider moves, so a frame fetched for an earlier one is not shown after a later one.
+    let seeking = 0;
+
+    const show_run = (id, last) => {
+        run = id;
+        history.replaceState(null, '', '#run=' + id);
+        frame_slider.setAttribute('max', last);
+        frame_slider.value = last;
+        frame_slider.disabled = false;
+    };
+
     socket.onmessage = msg => {
         switch (msg.type) {
             case 'setup':
                 chart.reset();
                 chart.set_params(msg.n);
+                world_size = msg.n;
+                view = null;
+                run = msg.run;
+                // Shown so the run can be had again (straight from the server's cache) by entering it.
+                seed_input.placeholder = msg.seed;
+                history.replaceState(null, '', '#run=' + msg.run);
                 frame_slider.disabled = true;
                 gen_nr.innerText = 0;
+                drawn = 0;
                 break;
             case 'data':
-                chart.add_frame(msg.value);
-                gen_nr.innerText = chart.num_frames();
+                chart.add_frame(msg.value, msg.n, msg.generation);
+                view = msg;
+                gen_nr.innerText = msg.generation;
+                if (++drawn == CREDIT_BATCH) {
+                    socket.send({
+                        type: 'credit',
+                        frames: drawn,
+                    });
+                    drawn = 0;
+                }
+                break;
+            case 'stats':
+                // Counts by cell type: empty, plants, the three kinds of bird, the three kinds of cat.
+                const c = msg.counts;
+                population.innerText = `plants ${c[1]}, birds ${c[2]}/${c[3]}/${c[4]}, cats ${c[5]}/${c[6]}/${c[7]}`;
+                break;
+            case 'queued':
+                console.log('Waiting for a free simulation worker, position', msg.position);
+                break;
+            case 'busy':
+                console.warn('The server is too busy to start another run, try again later');
+                break;
+            case 'invalid':
+                console.warn('The server turned down a message:', msg.message);
                 break;
             case 'finish':
-                const max_frames = chart.num_frames()-1;
-                frame_slider.setAttribute('max', max_frames);
-                frame_slider.disabled = false;
-                frame_slider.value = max_frames;
+                console.log('Run finished', msg.summary);
+                if (view) {
+                    show_run(run, view.generation);
+                }
         }
     }
 
@@ -37,8 +91,40 @@ window.addEventListener('load', () => {
             n: parseInt(size_input.value),
             p: parseFloat(pred_input.value),
             q: parseFloat(prey_input.value),
+            // Left empty, the server picks one.
+            seed: seed_input.value === '' ? null : parseInt(seed_input.value),
+            credits: FRAME_CREDITS,
+            policy: 'throttle',
+            stats: true,
+            // Frames need no more cells across than the canvas has pixels.
+            viewport: chart.w,
+        });
+    });
+
+    // Clicking the canvas zooms in on the spot clicked, ZOOM_FACTOR times closer,
+    // until cells are shown one by one; right-clicking shows the whole world again.
+    const ZOOM_FACTOR = 4;
+    chart.canvas.addEventListener('click', e => {
+        if (!view) {
+            return;
+        }
+        const size = Math.max(Math.ceil(view.size / ZOOM_FACTOR), 1);
+        const row = view.top + Math.floor(e.offsetY / chart.h * view.size);
+        const col = view.left + Math.floor(e.offsetX / chart.w * view.size);
+        socket.send({
+            type: 'zoom',
+            region: [row - Math.floor(size/2), col - Math.floor(size/2), size],
         });
     });
+    chart.canvas.addEventListener('contextmenu', e => {
+        e.preventDefault();
+        if (view && view.size < world_size) {
+            socket.send({
+                type: 'zoom',
+                region: null,
+            });
+        }
+    });
     stop_ca_button.addEventListener('click', () => {
         socket.send({
             type: 'stop',
@@ -62,15 +148,58 @@ window.addEventListener('load', () => {
         plant_input.value = 1-p-q;
     });
 
-    frame_slider.addEventListener('input', e => {
-        const frame_num = parseInt(e.target.value);
-        chart.set_frame(frame_num);
-        gen_nr.innerText = frame_num+1;
+    // The slider goes through generations; those not kept in the chart's own history come from the server.
+    frame_slider.addEventListener('input', async e => {
+        const generation = parseInt(e.target.value);
+        gen_nr.innerText = generation;
+        if (chart.show_generation(generation)) {
+            return;
+        }
+        const seek = ++seeking;
+        const frame = await fetch_frame(run, generation);
+        if (frame && seek == seeking) {
+            chart.show(frame.value, frame.n);
+            gen_nr.innerText = frame.generation;
+        }
     });
+
+    // Opening the page for a recorded run (#run=<id>) replays it from the server.
+    const replay = location.hash.match(/^#run=(\w+)$/);
+    if (replay) {
+        fetch('/runs/' + replay[1])
+            .then(response => response.ok ? response.json() : Promise.reject(response.statusText))
+            .then(info => {
+                if (info.last === null) {
+                    return;
+                }
+                chart.reset();
+                chart.set_params(info.n);
+                world_size = info.n;
+                show_run(info.run, info.last);
+                return fetch_frame(info.run, info.last).then(frame => {
+                    chart.show(frame.value, frame.n);
+                    gen_nr.innerText = frame.generation;
+                });
+            })
+            .catch(err => console.warn('Could not replay run', replay[1], err));
+    }
 });
 
+// The frame of a generation of a recorded run (or the first one after, if that was skipped),
+// fetched from the server; null if there is none.
+async function fetch_frame(run, generation) {
+    const response = await fetch(`/runs/${run}/frames?start=${generation}&stop=${generation+1}`);
+    const buffer = await response.arrayBuffer();
+    if (!response.ok || buffer.byteLength == 0) {
+        return null;
+    }
+    const length = new DataView(buffer).getUint32(0, true);
+    return new FrameDecoder().decode(buffer.slice(4, 4 + length));
+}
+
 class CAChart {
     constructor() {
+        // Colour of each cell type: empty, plant, birds (2-4), cats (5-7).
         this.colors = [
             '#000000',
             '#005500', 
@@ -82,7 +211,19 @@ class CAChart {
             '#6c66ff'
         ];
 
-        this.frames = [];
+        // The same colours as pixels (RGBA bytes, read as one 32 bit word), to look cell types up in.
+        this.palette = new Uint32Array(256);
+        const palette_bytes = new Uint8Array(this.palette.buffer);
+        this.colors.forEach((color, i) => {
+            palette_bytes.set([
+                parseInt(color.slice(1, 3), 16),
+                parseInt(color.slice(3, 5), 16),
+                parseInt(color.slice(5, 7), 16),
+                255,
+            ], 4*i);
+        });
+
+        this.history = new FrameHistory(HISTORY_BYTES);
 
         this.n = null;
 
@@ -94,6 +235,16 @@ class CAChart {
         // set canvas size to css-generated size
         this.canvas.width = this.w;
         this.canvas.height = this.h;
+        this.ctx.imageSmoothingEnabled = false;
+
+        // Frames are painted one pixel per cell into this image, reused from frame to frame,
+        // then scaled up onto the canvas in one go.
+        this.image = null;
+        this.buffer = document.createElement('canvas');
+        this.buffer_ctx = this.buffer.getContext('2d');
+
+        // The frame waiting to be drawn at the next animation frame, if any.
+        this.pending = null;
     }
 
     set_params(n) {
@@ -101,29 +252,96 @@ class CAChart {
     }
 
     reset() {
-        this.frames = [];
+        this.history = new FrameHistory(HISTORY_BYTES);
+        this.pending = null;
         this.ctx.clearRect(0, 0, this.w, this.h);
     }
 
-    add_frame(frame) {
-        const cell_width = this.w / this.n;
-        const cell_height = this.h / this.n;
-        for (let r = 0; r < this.n; r++) {
-            for (let c = 0; c < this.n; c++) {
-                const val = frame[r][c];
-                this.ctx.fillStyle = this.colors[val-1];
-                this.ctx.fillRect(cell_width*c, cell_height*r, cell_width, cell_height);
-            }
+    add_frame(frame, n, generation) {
+        // Frames may show the world downsampled or zoomed in, so are n cells across, whatever the world size.
+        this.history.add(generation, n, frame);
+        this.show(frame, n);
+    }
+
+    show_generation(generation) {
+        // Shows a generation from the history, if it was kept; returns whether it was.
+        const frame = this.history.find(generation);
+        if (frame) {
+            this.show(frame.cells, frame.n);
         }
-        this.frames.push(this.ctx.getImageData(0, 0, this.w, this.h));
+        return frame != null;
     }
-    
-    set_frame(frame_num) {
-        this.ctx.putImageData(this.frames[frame_num], 0, 0);
+
+    show(frame, n) {
+        // However fast frames come, only the latest one gets drawn, once per screen refresh.
+        if (!this.pending) {
+            requestAnimationFrame(() => {
+                this.draw(this.pending.frame, this.pending.n);
+                this.pending = null;
+            });
+        }
+        this.pending = {frame: frame, n: n};
     }
 
-    num_frames() {
-        return this.frames.length;
+    draw(frame, n) {
+        if (!this.image || this.image.width != n) {
+            this.image = this.buffer_ctx.createImageData(n, n);
+            this.pixels = new Uint32Array(this.image.data.buffer);
+            this.buffer.width = n;
+            this.buffer.height = n;
+        }
+        const pixels = this.pixels;
+        const palette = this.palette;
+        for (let i = 0; i < n*n; i++) {
+            pixels[i] = palette[frame[i]];
+        }
+        this.buffer_ctx.putImageData(this.image, 0, 0);
+        this.ctx.drawImage(this.buffer, 0, 0, this.w, this.h);
+    }
+}
+
+// Most bytes the frame history of a run may take.
+const HISTORY_BYTES = 64 << 20;
+
+// The frames of a run so far, one byte per cell, for the slider to go back to. Once they
+// would take more than max_bytes, every other frame is let go, and from then on only
+// every stride-th generation is kept; so a run of any length can still be gone through
+// from start to end, just more coarsely.
+class FrameHistory {
+    constructor(max_bytes) {
+        this.max_bytes = max_bytes;
+        this.frames = [];
+        this.bytes = 0;
+        this.stride = 1;
+    }
+
+    find(generation) {
+        // The frame of a generation, or null if it was not kept.
+        let lo = 0, hi = this.frames.length;
+        while (lo < hi) {
+            const mid = (lo + hi) >> 1;
+            if (this.frames[mid].generation < generation) {
+                lo = mid + 1;
+            } else {
+                hi = mid;
+            }
+        }
+        const frame = this.frames[lo];
+        return (frame && frame.generation == generation) ? frame : null;
+    }
+
+    add(generation, n, cells) {
+        if (generation % this.stride) {
+            return;
+        }
+        // The decoder keeps changing its frame in place, so keep a copy.
+        this.frames.push({generation: generation, n: n, cells: cells.slice()});
+        this.bytes += cells.length;
+        while (this.bytes > this.max_bytes && this.frames.length > 1) {
+            this.stride *= 2;
+            this.frames = this.frames.filter(frame => frame.generation % this.stride == 0);
+            this.bytes = this.frames.reduce((bytes, frame) => bytes + frame.cells.length, 0);
+        }
     }
 }
 
@@ -131,10 +349,14 @@ class ReconnectingJSONWebsocket {
     constructor(addr) {
         this.addr = addr;
         this.onmessage = () => {};
+        this._frames = new FrameDecoder();
+        // Messages are handled one after another, since decoding a frame may have to wait.
+        this._queue = Promise.resolve();
         this._connect();
     }
     _connect() {
         this._socket = new WebSocket(this.addr);
+        this._socket.binaryType = 'arraybuffer';
 
         this._socket.addEventListener('open', function (event) {
             console.log('Socket connected');
@@ -153,8 +375,10 @@ class ReconnectingJSONWebsocket {
         };
         
         this._socket.addEventListener('message', e => {
-            const msg = JSON.parse(e.data);
-            this.onmessage(msg)
+            this._queue = this._queue
+                .then(() => (e.data instanceof ArrayBuffer) ? this._frames.decode(e.data) : JSON.parse(e.data))
+                .then(msg => this.onmessage(msg))
+                .catch(err => console.error('Could not handle message', err));
         });
     }
     send(msg) {
@@ -164,4 +388,61 @@ class ReconnectingJSONWebsocket {
         }
         this._socket.send( JSON.stringify(msg) );
     }
-}
\ No newline at end of file
+}
+
+// Frames come as binary messages: a 24 byte header (little-endian: generation number,
+// n, encoding padded to 4 bytes, and the top row, left column and size of the square of
+// the world shown) followed by a payload that depends on the encoding. The frame is n
+// cells across, each standing for a block of size/n cells of the world.
+const FRAME_HEADER_SIZE = 24;
+const FRAME_RAW = 0;       // all n*n cell types, one byte per cell
+const FRAME_RAW_ZLIB = 1;  // the same, zlib-compressed
+const FRAME_DELTA = 2;     // the changed cells' positions (uint32), then their types
+const FRAME_XOR_ZLIB = 3;  // zlib-compressed XOR with the last frame
+
+function inflate(bytes) {
+    const stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream('deflate'));
+    return new Response(stream).arrayBuffer().then(buffer => new Uint8Array(buffer));
+}
+
+// Turns frames back into cell types, keeping the last one around to apply deltas to.
+class FrameDecoder {
+    constructor() {
+        this.current = null;
+    }
+
+    async decode(buffer) {
+        const header = new DataView(buffer, 0, FRAME_HEADER_SIZE);
+        const n = header.getUint32(4, true);
+        const encoding = header.getUint8(8);
+        let payload = new Uint8Array(buffer, FRAME_HEADER_SIZE);
+        if (encoding == FRAME_RAW_ZLIB || encoding == FRAME_XOR_ZLIB) {
+            payload = await inflate(payload);
+        }
+
+        if (encoding == FRAME_RAW || encoding == FRAME_RAW_ZLIB) {
+            this.current = payload.slice(0, n*n);
+        } else if (encoding == FRAME_DELTA) {
+            const count = payload.length / 5;
+            const positions = new Uint32Array(payload.buffer, payload.byteOffset, count);
+            const types = payload.subarray(4*count);
+            for (let i = 0; i < count; i++) {
+                this.current[positions[i]] = types[i];
+            }
+        } else {
+            for (let i = 0; i < n*n; i++) {
+                this.current[i] ^= payload[i];
+            }
+        }
+
+        return {
+            type: 'data',
+            generation: header.getUint32(0, true),
+            n: n,
+            top: header.getUint32(12, true),
+            left: header.getUint32(16, true),
+            size: header.getUint32(20, true),
+            value: this.current,
+        };
+    }
+}